@@ -2,12 +2,12 @@
 # -*- coding: utf-8 -*-
 
 """
-Make monthly CSV partitions from AmpPot raw inputs
+Make monthly Parquet/CSV partitions from AmpPot raw inputs
 
 Overview
 - Loads and normalizes raw AmpPot CSVs from both CISPA and YNU sources into a unified schema.  
 - Performs GeoIP enrichment using MaxMind databases (Country, City, ASN, Domain, ISP, Connection Type).  
-- Saves the enriched data as monthly CSV partitions by year/month, ready for RDAP enrichment.  
+- Saves the enriched data as monthly partitions by year/month (Parquet+zstd by default), ready for RDAP enrichment.  
 
 Sources (auto-detected)
 - CISPA: amppot_monthly/amppot-YYYY-MM-DD.csv  
@@ -16,8 +16,11 @@ Sources (auto-detected)
   → source=ynu, honeypot_type=proxied/agnostic
 
 Output
-  OUTDIR/enriched_monthly_all/<scope>/<YYYY>/<YYYY-MM>.csv  
-  where scope ∈ {all, cispa, ynu}
+  OUTDIR/enriched_monthly_all/<scope>/<YYYY>/<YYYY-MM>.parquet   (PART_FORMAT=parquet, default)
+  OUTDIR/enriched_monthly_all/<scope>/<YYYY>/<YYYY-MM>.csv       (PART_FORMAT=csv)
+  where scope ∈ SCOPES (default: all; also cispa, ynu)
+  The per-source views can be read from the `all` partitions with filter pushdown instead, e.g.
+    ds.dataset(path).to_table(filter=ds.field("source") == "cispa")
 
 Output schema (hpdate removed)
   target(=src), dport, t_start, t_end, packets,  
@@ -35,6 +38,13 @@ GeoIP Enrichment
 - GEOIP_DOMAIN : GeoIP2-Domain.mmdb → domain  
 - GEOIP_ISP    : GeoIP2-ISP.mmdb → isp, org 
 - GEOIP_CONTYPE: GeoIP2-Connection-Type.mmdb → contype  
+- Lookups run once per database over the unique source IPs (column-wise);
+  if `pandas_maxminddb` is installed, the City database is resolved with its
+  vectorized `geolocate`; the others are read with the raw `maxminddb` reader
+  (plain dict records, no geoip2 model objects).
+- Readers are opened once per process in MODE_MMAP_EXT, which needs the libmaxminddb
+  C library (e.g. `apt install libmaxminddb-dev` before `pip install maxminddb`);
+  without it the pure-Python reader is used, several times slower per lookup.
 
 Environment variables (examples)
   export AMPPOT_INDIR=amppot_monthly  
@@ -46,6 +56,11 @@ Environment variables (examples)
   export GEOIP_DOMAIN=GeoIP2-Domain.mmdb  
   export GEOIP_ISP=GeoIP2-ISP.mmdb  
   export GEOIP_CONTYPE=GeoIP2-Connection-Type.mmdb  
+  export GEOIP_CACHE=out_amp_wartime/.geoip_cache.parquet   # "" disables
+  export PART_FORMAT=parquet SCOPES=all                      # csv / all,cispa,ynu for the old layout
+  export WRITE_WORKERS=8                                     # concurrent partition writers
+  export GEOIP_COLLAPSE_24=1                                 # City/ASN/ISP/Domain per /24 (approximate)
+  export GEOIP_WORKERS=8                                     # lookup processes (default: all cores)
 
 Quickstart
   python3 maxmind_enrichment.py  
@@ -60,19 +75,28 @@ Quickstart
   COUNTRY_FILTER="RU,UA" python3 maxmind_enrichment.py  
 
 Pipeline linkage (next step)
-- The output from this script (`OUTDIR/enriched_monthly_all/all/YYYY/YYYY-MM.csv`)
+- The output from this script (`OUTDIR/enriched_monthly_all/all/YYYY/YYYY-MM.parquet`)
   is used as the input to the RDAP enrichment pipeline (rdap_enrichment.py),  
   which adds RDAP metadata and RU/UA consensus labels.
 
 Notes
 - Rows without valid `t_start` timestamps are dropped.  
+- Input files whose filename month lies entirely outside [START, END] are not read.
 - No shared-infrastructure exclusion is applied here (can be handled later via CDN filtering).
+- GeoIP results are memoized per source IP in GEOIP_CACHE (Parquet); rows are keyed on the
+  MMDB file mtimes, so replacing a database re-resolves its IPs on the next run.
 """
 
-import os, time, warnings
+import os, re, time, warnings, functools
 from pathlib import Path
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -82,6 +106,9 @@ OUTDIR       = Path(os.environ.get("OUTDIR", "out_amp_wartime")); OUTDIR.mkdir(p
 START        = pd.to_datetime(os.environ.get("START", "2022-01-01"))
 END          = pd.to_datetime(os.environ.get("END",   "2025-06-30"))
 COUNTRY_FILTER = [c.strip().upper() for c in os.environ.get("COUNTRY_FILTER","").split(",") if c.strip()]
+PART_FORMAT  = os.environ.get("PART_FORMAT", "parquet").strip().lower()   # parquet | csv
+SCOPES       = [c.strip().lower() for c in os.environ.get("SCOPES", "all").split(",") if c.strip()]
+WRITE_WORKERS = int(os.environ.get("WRITE_WORKERS", "8"))
 
 GEOIP_COUNTRY = os.environ.get("GEOIP_COUNTRY")
 GEOIP_CITY    = os.environ.get("GEOIP_CITY")
@@ -89,192 +116,330 @@ GEOIP_ASN     = os.environ.get("GEOIP_ASN")
 GEOIP_DOMAIN  = os.environ.get("GEOIP_DOMAIN")
 GEOIP_ISP     = os.environ.get("GEOIP_ISP")
 GEOIP_CONTYPE = os.environ.get("GEOIP_CONTYPE")
+GEOIP_PATHS   = {"country": GEOIP_COUNTRY, "city": GEOIP_CITY, "asn": GEOIP_ASN,
+                 "domain": GEOIP_DOMAIN, "isp": GEOIP_ISP, "contype": GEOIP_CONTYPE}
+GEOIP_WORKERS = int(os.environ.get("GEOIP_WORKERS", str(os.cpu_count() or 1)))
+GEOIP_COLLAPSE_24 = int(os.environ.get("GEOIP_COLLAPSE_24", "0"))  # resolve City/ASN/ISP/Domain per IPv4 /24
+GEOIP_CACHE   = os.environ.get("GEOIP_CACHE", str(OUTDIR / ".geoip_cache.parquet"))  # "" disables
 
 VERBOSE = int(os.environ.get("VERBOSE", "1"))
 
-def log(msg: str):
+def log(msg):
+    # msg may be a zero-arg callable (e.g. lambda: f"..."), formatted only when VERBOSE is on;
+    # one write per line so messages from writer threads do not interleave
     if VERBOSE:
-        print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+        print(f"[{time.strftime('%H:%M:%S')}] {msg() if callable(msg) else msg}\n", end="", flush=True)
 
 # Time helpers
 def to_naive_utc(series: pd.Series) -> pd.Series:
     """Normalize to timezone-naive UTC (assumes values are UTC or parseable)."""
-    dt = pd.to_datetime(series, errors="coerce", utc=True)
+    # both sources use ISO-8601 ("YYYY-MM-DD HH:MM:SS" for CISPA, "...THH:MM:SSZ" for YNU);
+    # pinning the format skips per-value format inference (pandas >= 2.0), unparseable rows -> NaT
+    dt = pd.to_datetime(series, format="ISO8601", errors="coerce", utc=True)
     return dt.dt.tz_convert(None)
 
-def ynu_mode_to_type(mode: str, amppot: str) -> str:
-    s = ((mode or "") + "|" + (amppot or "")).lower()
-    return "agnostic" if "agnostic" in s else "proxied"
+def ynu_mode_to_type(mode: pd.Series, amppot: pd.Series) -> np.ndarray:
+    s = mode.fillna("").astype(str).str.cat(amppot.fillna("").astype(str), sep="|").str.lower()
+    return np.where(s.str.contains("agnostic", regex=False), "agnostic", "proxied")
 
 # GeoIP enrichment
-def geoip_enrich(df: pd.DataFrame) -> pd.DataFrame:
-    """
-    Perform GeoIP enrichment using MaxMind databases (Country, City, ASN, Domain, ISP, Connection Type).
-    If a database is missing or cannot be opened, the corresponding fields are filled with defaults.
-    """
+GEO_COLS = ["geo_cc","geo_city","geo_domain","geo_asn","geo_as_org",
+            "geo_lat","geo_lon","geo_acc_km","geo_isp","geo_org","geo_contype"]
+GEO_NUM_COLS = {"geo_asn","geo_lat","geo_lon","geo_acc_km"}
 
-    try:
-        import geoip2.database
-    except Exception as e:
-        log(f"[geoip] geoip2 not available: {e} (skip)")
-        for c in ["geo_cc","geo_city","geo_domain","geo_asn","geo_as_org",
-                  "geo_lat","geo_lon","geo_acc_km","geo_isp","geo_org","geo_contype"]:
-            if c not in df: df[c] = np.nan if c in {"geo_lat","geo_lon","geo_acc_km"} else ""
-        return df
-
-    readers = {}
-    def _open(key, path):
-        if path and Path(path).exists():
-            try:
-                readers[key] = geoip2.database.Reader(path)
-                log(f"[geoip] opened {key}: {path}")
-            except Exception as e:
-                log(f"[geoip] failed {key}: {e}")
-
-    _open("country", GEOIP_COUNTRY)
-    _open("city",    GEOIP_CITY)
-    _open("asn",     GEOIP_ASN)
-    _open("domain",  GEOIP_DOMAIN)
-    _open("isp",     GEOIP_ISP)
-    _open("contype", GEOIP_CONTYPE)
-
-    if not readers:
-        log("[geoip] no db opened; skip enrichment")
-        for c in ["geo_cc","geo_city","geo_domain","geo_asn","geo_as_org",
-                  "geo_lat","geo_lon","geo_acc_km","geo_isp","geo_org","geo_contype"]:
-            if c not in df: df[c] = np.nan if c in {"geo_lat","geo_lon","geo_acc_km"} else ""
-        return df
+def _fill_geo_defaults(df: pd.DataFrame) -> pd.DataFrame:
+    for c in GEO_COLS:
+        if c not in df: df[c] = np.nan if c in GEO_NUM_COLS else ""
+    return df
 
-    ips = df["src"].dropna().unique().tolist()
-    rows = []
+def ipv4_to_u32(s: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pack dotted-quad IPv4 strings into uint32 (split/validate/cast all run in Arrow kernels).
+    Returns (u32, ok); ok is False (and u32 is 0) for rows that are not IPv4, e.g. IPv6 or junk.
+    """
+    arr = pa.array(s.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+    parts = pc.split_pattern(arr, ".")
+    ok = pc.fill_null(pc.equal(pc.list_value_length(parts), 4), False).to_numpy(zero_copy_only=False)
+    u32 = np.zeros(len(arr), dtype=np.uint32)
+    if not ok.any():
+        return u32, ok
+    flat = pc.list_flatten(parts.filter(ok))
+    # ASCII digits only: utf8_is_digit also accepts e.g. Arabic-Indic digits, which the cast cannot parse
+    digit = pc.match_substring_regex(flat, r"^[0-9]{1,3}$")
+    octets = pc.cast(pc.if_else(digit, flat, "0"), pa.uint32()).to_numpy().reshape(-1, 4)
+    valid = digit.to_numpy(zero_copy_only=False).reshape(-1, 4).all(axis=1) & (octets <= 255).all(axis=1)
+    idx = np.flatnonzero(ok)
+    u32[idx] = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+    ok[idx] = valid
+    u32[~ok] = 0
+    return u32, ok
+
+def _lookup_all(get, ips) -> list:
+    # one pass of a single reader over all IPs; misses/invalid IPs -> {}
+    out = []
     for ip in ips:
-        row = {"src": ip}
-        
-        # Country
         try:
-            if "country" in readers:
-                r = readers["country"].country(ip)
-                row["geo_cc"] = (r.country.iso_code or r.registered_country.iso_code or "")
-            else:
-                row["geo_cc"] = ""
+            out.append(get(ip) or {})
         except Exception:
-            row["geo_cc"] = ""
-
-        # City + location
-        try:
-            if "city" in readers:
-                r = readers["city"].city(ip)
-                row["geo_city"] = (r.city.name or "")
-                loc = getattr(r, "location", None)
-                if loc is not None:
-                    row["geo_lat"] = loc.latitude
-                    row["geo_lon"] = loc.longitude
-                    row["geo_acc_km"] = getattr(loc, "accuracy_radius", None)
-                else:
-                    row["geo_lat"] = np.nan
-                    row["geo_lon"] = np.nan
-                    row["geo_acc_km"] = np.nan
-            else:
-                row["geo_city"] = ""
-                row["geo_lat"] = np.nan
-                row["geo_lon"] = np.nan
-                row["geo_acc_km"] = np.nan
-        except Exception:
-            row["geo_city"] = ""
-            row["geo_lat"] = np.nan
-            row["geo_lon"] = np.nan
-            row["geo_acc_km"] = np.nan
+            out.append({})
+    return out
 
-        # ASN
+# dispatch table: database -> {geo column: extractor over the raw MMDB record dict}
+GEOIP_LOOKUPS = (
+    ("country", {"geo_cc":     lambda r: (r.get("country", {}).get("iso_code") or
+                                          r.get("registered_country", {}).get("iso_code") or "")}),
+    ("city",    {"geo_city":   lambda r: r.get("city", {}).get("names", {}).get("en") or "",
+                 "geo_lat":    lambda r: r.get("location", {}).get("latitude", np.nan),
+                 "geo_lon":    lambda r: r.get("location", {}).get("longitude", np.nan),
+                 "geo_acc_km": lambda r: r.get("location", {}).get("accuracy_radius", np.nan)}),
+    ("asn",     {"geo_asn":    lambda r: r.get("autonomous_system_number", np.nan),
+                 "geo_as_org": lambda r: r.get("autonomous_system_organization") or ""}),
+    ("domain",  {"geo_domain": lambda r: r.get("domain") or ""}),
+    ("isp",     {"geo_isp":    lambda r: r.get("isp") or "",
+                 "geo_org":    lambda r: r.get("organization") or ""}),
+    ("contype", {"geo_contype": lambda r: r.get("connection_type") or ""}),
+)
+ASN_FROM_ISP = dict(GEOIP_LOOKUPS)["asn"]
+# databases whose answer is (practically) constant within an IPv4 /24; see GEOIP_COLLAPSE_24
+COLLAPSE_24_DBS = {"city", "asn", "isp", "domain"}
+
+@functools.lru_cache(maxsize=None)
+def _get_reader(kind: str):
+    """
+    Open the MMDB configured for `kind` once per process and keep it for the process lifetime.
+    Uses the libmaxminddb C extension (MODE_MMAP_EXT); falls back to the pure-Python mmap reader
+    when the extension is not built. Returns None if the database is unset or cannot be opened.
+    """
+    path = GEOIP_PATHS.get(kind)
+    if not (path and Path(path).exists()):
+        return None
+    try:
+        import maxminddb
+    except Exception as e:
+        log(f"[geoip] maxminddb not available: {e} (skip {kind})")
+        return None
+    try:
         try:
-            if "asn" in readers:
-                r = readers["asn"].asn(ip)
-                row["geo_asn"] = r.autonomous_system_number
-                row["geo_as_org"] = (r.autonomous_system_organization or "")
-            else:
-                row["geo_asn"] = np.nan
-                row["geo_as_org"] = ""
-        except Exception:
-            row["geo_asn"] = np.nan
-            row["geo_as_org"] = ""
+            rd = maxminddb.open_database(path, maxminddb.MODE_MMAP_EXT)
+        except ValueError:
+            log(f"[geoip] libmaxminddb extension not available; pure-Python reader for {kind}")
+            rd = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+        log(f"[geoip] opened {kind}: {path}")
+        return rd
+    except Exception as e:
+        log(f"[geoip] failed {kind}: {e}")
+        return None
 
-        # Domain
-        try:
-            if "domain" in readers:
-                r = readers["domain"].domain(ip)
-                row["geo_domain"] = getattr(r, "domain", "") or ""
-            else:
-                row["geo_domain"] = ""
-        except Exception:
-            row["geo_domain"] = ""
+def _geo_lookup_chunk(ips) -> pd.DataFrame:
+    """
+    Resolve IPs against the MaxMind databases (Country, City, ASN, Domain, ISP, Connection Type).
+    Lookups run column-wise, one pass per database; the City database goes through
+    pandas_maxminddb (vectorized) when it is installed.
+    Returns one row per IP with the geo_* columns, or None when no database could be opened.
+    """
 
-        # ISP / Organization
-        try:
-            if "isp" in readers:
-                r = readers["isp"].isp(ip)
-                row["geo_isp"] = getattr(r, "isp", "") or ""
-                row["geo_org"] = getattr(r, "organization", "") or ""
-
-                # ASN fallback: when ASN DB is not available, use ISP fields if present
-                if "asn" not in readers:
-                    asn_fallback = getattr(r, "autonomous_system_number", None)
-                    asorg_fallback = getattr(r, "autonomous_system_organization", "") or ""
-                    if row.get("geo_asn") is np.nan or pd.isna(row.get("geo_asn")):
-                        row["geo_asn"] = asn_fallback
-                    if not row.get("geo_as_org"):
-                        row["geo_as_org"] = asorg_fallback
-            else:
-                row["geo_isp"] = ""
-                row["geo_org"] = ""
-        except Exception:
-            row["geo_isp"] = ""
-            row["geo_org"] = ""
+    try:
+        import pandas_maxminddb
+    except Exception:
+        pandas_maxminddb = None
 
-        # Connection type
-        try:
-            if "contype" in readers:
-                r = readers["contype"].connection_type(ip)
-                row["geo_contype"] = getattr(r, "connection_type", "") or ""
-            else:
-                row["geo_contype"] = ""
-        except Exception:
-            row["geo_contype"] = ""
+    city_vec = bool(pandas_maxminddb and GEOIP_CITY and Path(GEOIP_CITY).exists())
+    if city_vec:
+        log(f"[geoip] city via pandas_maxminddb: {GEOIP_CITY}")
 
-        rows.append(row)
+    readers = {}
+    for key in GEOIP_PATHS:
+        if key == "city" and city_vec:
+            continue
+        rd = _get_reader(key)
+        if rd is not None:
+            readers[key] = rd
+
+    if not readers and not city_vec:
+        log("[geoip] no db opened; skip enrichment")
+        return None
+
+    ips = list(ips)
+    n = len(ips)
+    # one preallocated array per output column (defaults: "" / NaN), filled in place per database
+    cols = {c: np.full(n, np.nan) if c in GEO_NUM_COLS else np.full(n, "", dtype=object) for c in GEO_COLS}
+
+    # City + location (vectorized path)
+    if city_vec:
+        with pandas_maxminddb.open_database(GEOIP_CITY) as rd:
+            loc = pd.DataFrame({"src": ips}).geo.geolocate("src", rd, ["city","latitude","longitude","accuracy_radius"])
+        cols["geo_city"][:]   = loc["city"].fillna("").astype(str).to_numpy(dtype=object)
+        cols["geo_lat"][:]    = pd.to_numeric(loc["latitude"], errors="coerce").to_numpy(dtype=float)
+        cols["geo_lon"][:]    = pd.to_numeric(loc["longitude"], errors="coerce").to_numpy(dtype=float)
+        cols["geo_acc_km"][:] = pd.to_numeric(loc["accuracy_radius"], errors="coerce").to_numpy(dtype=float)
+
+    # optional /24 collapse: look up one representative (x.y.z.0) per IPv4 /24 and broadcast back
+    if GEOIP_COLLAPSE_24:
+        net24 = pd.Series(ips, dtype=object).str.replace(r"^(\d+\.\d+\.\d+)\.\d+$", r"\1.0", regex=True)
+        reps, inv = np.unique(net24.to_numpy(dtype=str), return_inverse=True)
+        log(f"[geoip] /24 collapse: {n} IPs -> {len(reps)} lookups for {sorted(COLLAPSE_24_DBS)}")
+
+    def _fill(fields, recs, idx=None):
+        # extract each field once per record; `idx` broadcasts per-/24 values back to the IPs
+        for col, extract in fields.items():
+            arr = cols[col]
+            vals = np.array([extract(r) for r in recs], dtype=arr.dtype)
+            arr[:] = vals if idx is None else vals[idx]
+
+    # one pass per opened database; columns of unopened databases keep their defaults
+    recs_by_db = {}
+    for key, fields in GEOIP_LOOKUPS:
+        rd = readers.get(key)
+        if rd is None:
+            continue
+        if GEOIP_COLLAPSE_24 and key in COLLAPSE_24_DBS:
+            recs_by_db[key] = (_lookup_all(rd.get, reps), inv)
+        else:
+            recs_by_db[key] = (_lookup_all(rd.get, ips), None)
+        _fill(fields, *recs_by_db[key])
 
-    geo = pd.DataFrame(rows)
-    out = df.merge(geo, on="src", how="left")
+    # ASN fallback: when ASN DB is not available, use ISP fields if present
+    if "asn" not in readers and "isp" in recs_by_db:
+        _fill(ASN_FROM_ISP, *recs_by_db["isp"])
 
-    # string fields
-    for c in ["geo_cc","geo_city","geo_domain","geo_as_org","geo_isp","geo_org","geo_contype"]:
-        if c in out:
-            out[c] = out[c].fillna("")
+    geo = pd.DataFrame({"src": ips, **cols}, copy=False)
+    geo["geo_asn"] = geo["geo_asn"].astype("Int64")
+    return geo
 
-    # numeric casts
-    if "geo_asn" in out: out["geo_asn"] = pd.to_numeric(out["geo_asn"], errors="coerce").astype("Int64")
-    for c in ["geo_lat", "geo_lon", "geo_acc_km"]:
-        if c in out:
-            out[c] = pd.to_numeric(out[c], errors="coerce")
+GEOIP_MIN_CHUNK = 10_000   # below this many IPs per worker, process startup outweighs the lookups
 
-    # close readers cleanly
+def geoip_lookup(ips) -> pd.DataFrame:
+    """
+    Resolve unique IPs, sharded across GEOIP_WORKERS processes.
+    Each worker opens its own readers (mmap'd pages are shared by the OS), so no reader is shared between workers.
+    """
+    n_jobs = max(1, min(GEOIP_WORKERS, len(ips) // GEOIP_MIN_CHUNK))
+    if n_jobs == 1:
+        return _geo_lookup_chunk(ips)
+    log(f"[geoip] resolving {len(ips)} IPs with {n_jobs} workers")
+    with ProcessPoolExecutor(max_workers=n_jobs) as ex:
+        parts = list(ex.map(_geo_lookup_chunk, np.array_split(np.asarray(ips), n_jobs)))
+    if any(p is None for p in parts):
+        return None
+    return pd.concat(parts, ignore_index=True)
+
+# GeoIP cache (IP -> geo_* row, persisted across runs)
+def _mmdb_key() -> str:
+    # build-id of the configured databases: a refreshed/replaced MMDB invalidates cached rows
+    parts = []
+    for key, path in GEOIP_PATHS.items():
+        if path and Path(path).exists():
+            parts.append(f"{key}:{Path(path).stat().st_mtime_ns}")
+    if GEOIP_COLLAPSE_24:
+        parts.append("collapse24")
+    return "|".join(parts)
+
+def load_geo_cache(path: Path, mmdb_key: str) -> pd.DataFrame:
+    if not path.exists():
+        return pd.DataFrame(columns=["src", *GEO_COLS])
     try:
-        for rd in readers.values():
-            rd.close()
-    except Exception:
-        pass
+        cache = pd.read_parquet(path)
+    except Exception as e:
+        log(f"[geoip] cache unreadable, ignoring: {path} ({e})")
+        return pd.DataFrame(columns=["src", *GEO_COLS])
+    n0 = len(cache)
+    cache = cache[cache["mmdb_key"] == mmdb_key].drop(columns=["mmdb_key"])
+    log(f"[geoip] cache {path}: {len(cache)} valid rows (stale {n0 - len(cache)})")
+    return cache
+
+def save_geo_cache(path: Path, cache: pd.DataFrame, mmdb_key: str):
+    tmp = Path(str(path) + ".tmp")
+    cache.assign(mmdb_key=mmdb_key).to_parquet(tmp, compression="zstd", index=False)
+    os.replace(tmp, path)
 
+def geoip_enrich(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Attach geo_* columns to df by source IP.
+    Only IPs missing from the on-disk cache (GEOIP_CACHE) are looked up; the delta is appended to the cache.
+    If a database is missing or cannot be opened, the corresponding fields are filled with defaults.
+    """
+    # IPv4 sources dedup on packed uint32 (sorted, so /24s stay adjacent across worker shards) and are
+    # looked up and merged in canonical dotted form, so every spelling of an address (e.g. leading zeros)
+    # gets its geo row; anything else dedups and merges as strings
+    src = df["src"]
+    u32, ok = ipv4_to_u32(src)
+    uniq, inv = np.unique(u32[ok], return_inverse=True)
+    v4 = np.array([f"{u >> 24}.{u >> 16 & 255}.{u >> 8 & 255}.{u & 255}" for u in uniq.tolist()], dtype=object)
+    key = src.to_numpy(dtype=object).copy()
+    key[ok] = v4[inv]
+    ips = np.concatenate([v4.astype(str), src[~ok].dropna().unique().astype(str)])
+
+    cache_path = Path(GEOIP_CACHE) if GEOIP_CACHE else None
+    mmdb_key = _mmdb_key()
+    cache = load_geo_cache(cache_path, mmdb_key) if cache_path else pd.DataFrame(columns=["src", *GEO_COLS])
+
+    new_ips = ips[~np.isin(ips, cache["src"].to_numpy(dtype=str))]
+    log(f"[geoip] unique IPs: {len(ips)} | cached: {len(ips) - len(new_ips)} | to resolve: {len(new_ips)}")
+
+    if len(new_ips):
+        geo_new = geoip_lookup(new_ips)
+        if geo_new is None:
+            return _fill_geo_defaults(df)
+        cache = pd.concat([cache, geo_new], ignore_index=True) if len(cache) else geo_new
+        if cache_path:
+            cache = cache.drop_duplicates("src", keep="last")
+            save_geo_cache(cache_path, cache, mmdb_key)
+            log(f"[geoip] cache {cache_path}: +{len(geo_new)} rows (total {len(cache)})")
+
+    geo = cache[cache["src"].isin(ips)].rename(columns={"src": "_geo_key"})
+    out = df.merge(geo, left_on=key, right_on="_geo_key", how="left").drop(columns="_geo_key")
+    for c in ["geo_cc","geo_city","geo_domain","geo_as_org","geo_isp","geo_org","geo_contype"]:
+        out[c] = out[c].fillna("")
     return out
 
 # Loaders
-def load_cispa_files() -> pd.DataFrame:
-    paths = sorted([p for p in AMPPOT_INDIR.glob("amppot-*.csv") if "ynu" not in p.name])
-    log(f"[load] CISPA files matched: {len(paths)}")
-    rows = []
+def read_csv_arrow(path: Path) -> pd.DataFrame:
+    """
+    Multi-threaded CSV read via pyarrow. Clean numeric/timestamp columns arrive already typed,
+    so the to_numeric/to_naive_utc passes below are cheap; dirty columns stay strings and are coerced there.
+    """
+    tbl = pacsv.read_csv(path, read_options=pacsv.ReadOptions(use_threads=True))
+    return tbl.to_pandas()
+
+# unified per-file schema: files whose columns were inferred differently (e.g. all-null, numeric-looking)
+# are cast to it so that the Arrow tables concatenate without a pandas round-trip
+LOAD_SCHEMA = pa.schema([
+    ("dport", pa.int64()), ("src", pa.string()),
+    ("t_start", pa.timestamp("ns")), ("t_end", pa.timestamp("ns")), ("packets", pa.int64()),
+    ("country", pa.string()), ("countrycode", pa.string()), ("city", pa.string()),
+    ("domain", pa.string()), ("asnum", pa.float64()), ("asorg", pa.string()), ("hostname", pa.string()),
+    ("source", pa.string()), ("honeypot_type", pa.string()),
+])
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    if "asnum" in df.columns:
+        df = df.assign(asnum=pd.to_numeric(df["asnum"], errors="coerce"))
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    return tbl.cast(pa.schema([LOAD_SCHEMA.field(c) for c in tbl.column_names]))
+
+# month encoded in the input filename (amppot-YYYY-MM-DD.csv / amppot-ynu_jihye_YYYYMM.csv)
+FILE_MONTH_RE = re.compile(r"(\d{4})-?(\d{2})(?:-\d{2})?\.csv$")
+
+def in_window(p: Path) -> bool:
+    """False only when the filename's month lies entirely outside [START, END]; unparseable names are kept."""
+    m = FILE_MONTH_RE.search(p.name)
+    if not m:
+        return True
+    month = pd.Period(f"{m.group(1)}-{m.group(2)}", freq="M")
+    return month.end_time >= START and month.start_time <= END
+
+def _select_files(paths: list, label: str) -> list:
+    kept = [p for p in paths if in_window(p)]
+    log(f"[load] {label} files matched: {len(paths)} (in window: {len(kept)})")
+    return kept
+
+def load_cispa_files() -> Iterator[pa.Table]:
+    paths = _select_files(sorted([p for p in AMPPOT_INDIR.glob("amppot-*.csv") if "ynu" not in p.name]), "CISPA")
     for i, p in enumerate(paths, 1):
-        log(f"[load] CISPA [{i}/{len(paths)}] reading {p.name} ...")
-        df = pd.read_csv(p, sep=",", engine="c", dtype=str, encoding="utf-8", low_memory=False)
+        log(lambda: f"[load] CISPA [{i}/{len(paths)}] reading {p.name} ...")
+        df = read_csv_arrow(p)
         n0 = len(df)
-        log(f"[load]   shape={df.shape}  columns={list(df.columns)}")
+        log(lambda: f"[load]   shape={df.shape}  columns={list(df.columns)}")
 
         # normalize columns
         if "src" not in df.columns and "target" in df.columns:
@@ -298,19 +463,17 @@ def load_cispa_files() -> pd.DataFrame:
         keep = ["dport","src","t_start","t_end","packets",
                 "countrycode","city","domain","asnum","asorg","hostname",
                 "source","honeypot_type"]
-        rows.append(df[[c for c in keep if c in df.columns]])
-        log(f"[load]   kept_columns={list(rows[-1].columns)} kept_rows={len(rows[-1])} (file_rows={n0})")
-    return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame()
-
-def load_ynu_files() -> pd.DataFrame:
-    paths = sorted(AMPPOT_INDIR.glob("amppot-ynu_jihye_*.csv"))
-    log(f"[load] YNU files matched: {len(paths)}")
-    rows = []
+        tbl = _to_arrow(df[[c for c in keep if c in df.columns]])
+        log(lambda: f"[load]   kept_columns={tbl.column_names} kept_rows={tbl.num_rows} (file_rows={n0})")
+        yield tbl
+
+def load_ynu_files() -> Iterator[pa.Table]:
+    paths = _select_files(sorted(AMPPOT_INDIR.glob("amppot-ynu_jihye_*.csv")), "YNU")
     for i, p in enumerate(paths, 1):
-        log(f"[load] YNU   [{i}/{len(paths)}] reading {p.name} ...")
-        df = pd.read_csv(p, sep=",", engine="c", dtype=str, encoding="utf-8", low_memory=False)
+        log(lambda: f"[load] YNU   [{i}/{len(paths)}] reading {p.name} ...")
+        df = read_csv_arrow(p)
         n0 = len(df)
-        log(f"[load]   shape={df.shape}  columns={list(df.columns)}")
+        log(lambda: f"[load]   shape={df.shape}  columns={list(df.columns)}")
 
         # column mapping
         df["src"]     = df.get("target")
@@ -327,37 +490,44 @@ def load_ynu_files() -> pd.DataFrame:
         if "totalpacket" in df.columns:
             df["packets"] = pd.to_numeric(df["totalpacket"], errors="coerce").fillna(0).astype("Int64")
 
-        modes = df.get("mode",   pd.Series([""]*len(df)))
-        pots  = df.get("amppot", pd.Series([""]*len(df)))
+        modes = df.get("mode",   pd.Series("", index=df.index))
+        pots  = df.get("amppot", pd.Series("", index=df.index))
         df["source"] = "ynu"
-        df["honeypot_type"] = [ynu_mode_to_type(m, a) for m, a in zip(modes, pots)]
+        df["honeypot_type"] = ynu_mode_to_type(modes, pots)
 
         keep = ["dport","src","t_start","t_end","packets",
                 "country","countrycode","city","domain","asnum","asorg","hostname",
                 "source","honeypot_type"]
-        df2 = df[[c for c in keep if c in df.columns]].copy()
+        df2 = df[[c for c in keep if c in df.columns]]
 
         before = len(df2)
         df2 = df2.drop_duplicates(subset=["src","dport","t_start","t_end","honeypot_type"], keep="first")
-        log(f"[dedup: YNU by (src,dport,t_start,t_end,honeypot_type)] {p.name}: {before} -> {len(df2)}")
+        log(lambda: f"[dedup: YNU by (src,dport,t_start,t_end,honeypot_type)] {p.name}: {before} -> {len(df2)}")
 
-        rows.append(df2)
-        log(f"[load]   kept_columns={list(df2.columns)} kept_rows={len(df2)} (file_rows={n0})")
-    return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame()
+        tbl = _to_arrow(df2)
+        log(lambda: f"[load]   kept_columns={tbl.column_names} kept_rows={tbl.num_rows} (file_rows={n0})")
+        yield tbl
 
 # Load + merge + normalize
 def load_all() -> pd.DataFrame:
     t0 = time.time()
-    cispa = load_cispa_files()
-    ynu   = load_ynu_files()
-
-    log(f"[load] cispa rows total: {len(cispa)} | cols={list(cispa.columns)}")
-    log(f"[load] ynu   rows total: {len(ynu)}   | cols={list(ynu.columns)}")
-
-    if cispa.empty and ynu.empty:
+    # each per-file Arrow table is folded into one table as it is read (zero-copy, chunks are appended);
+    # the pandas conversion frees the Arrow buffers column by column, so both copies are never held in full
+    acc, rows = None, {"cispa": 0, "ynu": 0}
+    for name, tables in (("cispa", load_cispa_files()), ("ynu", load_ynu_files())):
+        for t in tables:
+            rows[name] += t.num_rows
+            acc = t if acc is None else pa.concat_tables([acc, t], promote_options="default")
+            del t
+
+    log(lambda: f"[load] cispa rows total: {rows['cispa']}")
+    log(lambda: f"[load] ynu   rows total: {rows['ynu']}")
+
+    if not (rows["cispa"] or rows["ynu"]):
         raise SystemExit(f"No input rows parsed. Check files under: {AMPPOT_INDIR}")
 
-    all_df = pd.concat([cispa, ynu], ignore_index=True, sort=False)
+    all_df = acc.to_pandas(split_blocks=True, self_destruct=True)
+    del acc
 
     for c in ["t_start","t_end"]:
         if c in all_df.columns:
@@ -365,114 +535,139 @@ def load_all() -> pd.DataFrame:
     for c in ["dport","packets","asnum"]:
         if c in all_df.columns:
             all_df[c] = pd.to_numeric(all_df[c], errors="coerce")
+    all_df["src"] = all_df["src"].astype(str)
+    # low-cardinality labels: int8 codes instead of per-row Python strings
+    for c in ["source","honeypot_type"]:
+        all_df[c] = all_df[c].astype("category")
 
-    # filter by START/END using t_start
-    all_df = all_df[(all_df["t_start"] >= START) & (all_df["t_start"] <= END)].copy()
+    # filter by START/END using t_start (rows without t_start fail both bounds);
+    # no .copy(): the filtered frame is only read from here on (geoip_enrich merges into a new frame)
     n0 = len(all_df)
-    all_df = all_df[all_df["t_start"].notna()].copy()
-    if len(all_df) != n0:
-        log(f"[filter] dropped rows without t_start: {n0} -> {len(all_df)}")
+    all_df = all_df.loc[(all_df["t_start"] >= START) & (all_df["t_start"] <= END)]
+    log(f"[filter] t_start in [{START.date()}, {END.date()}]: {n0} -> {len(all_df)}")
 
     # GeoIP enrichment (adds cc/city/lat/lon/acc/asn/asorg/domain/isp/org/contype)
-    all_df = geoip_enrich(all_df.assign(src=all_df["src"].astype(str)))
+    all_df = geoip_enrich(all_df)
 
     return all_df
 
 # Final normalized view
-def make_final_view(df: pd.DataFrame) -> pd.DataFrame:
-    out = df.copy()
+def _coalesce(primary: pd.Series, fallback: pd.Series) -> pd.Series:
+    # primary where it is non-empty, else fallback (one pass over the raw object array)
+    p = primary.to_numpy(dtype=object)
+    return primary.where(pd.notna(p) & (p != ""), fallback)
 
-    # ensure column exists to avoid .get(None) errors
-    if "countrycode" not in out.columns:
-        out["countrycode"] = ""
+def make_final_view(df: pd.DataFrame) -> pd.DataFrame:
+    def col(name, dtype=object):
+        if name in df.columns:
+            return df[name]
+        return pd.Series(pd.NA if dtype == "Int64" else "", index=df.index, dtype=dtype)
 
     # fill country/city/domain/asn/asorg if missing, from GeoIP
-    if "geo_cc" in out.columns:
-        miss = out["countrycode"].isna() | (out["countrycode"].astype(str)=="")
-        out.loc[miss, "countrycode"] = out.loc[miss, "geo_cc"]
-
-    if "geo_city" in out.columns:
-        if "city" not in out.columns:
-            out["city"] = ""
-        miss = out["city"].isna() | (out["city"].astype(str)=="")
-        out.loc[miss, "city"] = out["geo_city"]
-
-    if "geo_domain" in out.columns:
-        if "domain" not in out.columns:
-            out["domain"] = ""
-        miss = out["domain"].isna() | (out["domain"].astype(str)=="")
-        out.loc[miss, "domain"] = out["geo_domain"]
-
-    if "geo_asn" in out.columns:
-        if "asnum" not in out.columns:
-            out["asnum"] = pd.Series([pd.NA]*len(out), dtype="Int64")
-        else:
-            out["asnum"] = pd.to_numeric(out["asnum"], errors="coerce").astype("Int64")
-        out["geo_asn"] = pd.to_numeric(out["geo_asn"], errors="coerce").astype("Int64")
-        miss = out["asnum"].isna()
-        out.loc[miss, "asnum"] = out["geo_asn"]
-
-    if "geo_as_org" in out.columns:
-        if "asorg" not in out.columns:
-            out["asorg"] = ""
-        miss = out["asorg"].isna() | (out["asorg"].astype(str)=="")
-        out.loc[miss, "asorg"] = out["geo_as_org"]
-
-    # produce a clean, fixed schema:
+    cc     = _coalesce(col("countrycode"), col("geo_cc"))
+    city   = _coalesce(col("city"),        col("geo_city"))
+    domain = _coalesce(col("domain"),      col("geo_domain"))
+    asorg  = _coalesce(col("asorg"),       col("geo_as_org"))
+    asnum  = col("asnum", "Int64").astype("Int64").fillna(col("geo_asn", "Int64").astype("Int64"))
+
+    # produce a clean, fixed schema (load_all/geoip_enrich already cast numeric columns):
     final = pd.DataFrame({
-        "target":        out["src"].astype(str),
-        "dport":         pd.to_numeric(out["dport"], errors="coerce").astype("Int64"),
-        "t_start":       out["t_start"],
-        "t_end":         out["t_end"],
-        "packets":       pd.to_numeric(out["packets"], errors="coerce").fillna(0).astype("Int64"),
+        "target":        df["src"].astype(str),
+        "dport":         df["dport"].astype("Int64"),
+        "t_start":       df["t_start"],
+        "t_end":         df["t_end"],
+        "packets":       df["packets"].fillna(0).astype("Int64"),
 
-        "countrycode":   out.get("countrycode","").astype(str).str.upper(),
-        "city":          out.get("city",""),
-        "latitude":      pd.to_numeric(out.get("geo_lat"), errors="coerce"),
-        "longitude":     pd.to_numeric(out.get("geo_lon"), errors="coerce"),
-        "loc_acc_km":    pd.to_numeric(out.get("geo_acc_km"), errors="coerce"),
+        "countrycode":   pd.Categorical(np.char.upper(cc.fillna("").to_numpy(dtype=str))),
+        "city":          city,
+        "latitude":      df["geo_lat"],
+        "longitude":     df["geo_lon"],
+        "loc_acc_km":    df["geo_acc_km"],
 
-        "domain":        out.get("domain",""),
+        "domain":        domain,
 
-        "asnum":         pd.to_numeric(out.get("asnum"), errors="coerce").astype("Int64") if "asnum" in out else pd.Series([pd.NA]*len(out), dtype="Int64"),
-        "asorg":         out.get("asorg","").astype(str),
+        "asnum":         asnum,
+        "asorg":         asorg.astype(str),
 
         # from GeoIP2-ISP.mmdb
-        "isp":           out.get("geo_isp","").astype(str),
-        "org":           out.get("geo_org","").astype(str),
+        "isp":           col("geo_isp").astype(str),
+        "org":           col("geo_org").astype(str),
 
         # from GeoIP2-Connection-Type.mmdb
-        "contype":       out.get("geo_contype","").astype(str),
+        "contype":       col("geo_contype").astype(str).astype("category"),
 
         # passthrough if present in sources (e.g., YNU)
-        "hostname":      out.get("hostname","").astype(str),
+        "hostname":      col("hostname").fillna("").astype(str),
 
-        "source":        out["source"].str.lower(),
-        "honeypot_type": out["honeypot_type"],
-    })
+        "source":        df["source"].astype("category").cat.rename_categories(str.lower),
+        "honeypot_type": df["honeypot_type"].astype("category"),
 
+        # partition keys
+        "month":         df["t_start"].dt.to_period("M").astype(str),
+        "year":          df["t_start"].dt.year.astype(int),
+    }, index=df.index)
+
+    # filter last, so no column is assigned onto the filtered frame (no .copy() needed)
     if COUNTRY_FILTER:
         n0 = len(final)
-        final = final[final["countrycode"].isin(COUNTRY_FILTER) | final["countrycode"].eq("")].copy()
+        final = final.loc[final["countrycode"].isin(COUNTRY_FILTER) | final["countrycode"].eq("")]
         log(f"[filter] country {COUNTRY_FILTER}: {n0} -> {len(final)}")
 
-    final["month"] = final["t_start"].dt.to_period("M").astype(str)
-    final["year"]  = final["t_start"].dt.year.astype(int)
-    log(f"[final] rows={len(final)} months={final['month'].nunique()}")
+    log(lambda: f"[final] rows={len(final)} months={final['month'].nunique()}")
     return final
 
 # Writer
-def write_monthly_partitions(df: pd.DataFrame, scope: str):
-    base = OUTDIR / "enriched_monthly_all" / scope
-    base.mkdir(parents=True, exist_ok=True)
-    groups = list(df.groupby(["year","month"], sort=True))
-    log(f"[write] {scope}: months={len(groups)}")
-    for (year, month), g in groups:
-        year_dir = base / f"{year}"
+def write_monthly_partitions(df: pd.DataFrame, scopes: list):
+    """
+    Write <scope>/<YYYY>/<YYYY-MM>.<ext> for every scope in one pass.
+    The view is converted to Arrow and sorted by (month, source) once; each month is then a contiguous
+    row run ("all"), and each source scope a contiguous sub-run of it, so every partition is a
+    zero-copy slice located with searchsorted (no groupby, no per-scope filtering).
+    """
+    tbl = pa.Table.from_pandas(df.drop(columns=["year"], errors="ignore"), preserve_index=False)
+    # sort keys are decoded to plain strings (Arrow cannot sort dictionary/categorical columns)
+    keys = pa.table({"month": tbl["month"].cast(pa.string()), "source": tbl["source"].cast(pa.string())})
+    order = pc.sort_indices(keys, sort_keys=[("month", "ascending"), ("source", "ascending")])
+    keys = keys.take(order)
+    tbl = tbl.take(order).drop_columns(["month"])
+    month  = keys["month"].to_numpy(zero_copy_only=False)
+    source = keys["source"].to_numpy(zero_copy_only=False)
+
+    bounds = np.flatnonzero(month[1:] != month[:-1]) + 1
+    starts = np.concatenate(([0], bounds)).astype(int) if len(month) else np.array([], dtype=int)
+    ends   = np.concatenate((bounds, [len(month)])).astype(int) if len(month) else np.array([], dtype=int)
+
+    jobs = []
+    for a, b in zip(starts, ends):
+        for scope in scopes:
+            if scope == "all":
+                lo, hi = a, b
+            else:
+                run = source[a:b]
+                lo = a + int(np.searchsorted(run, scope, side="left"))
+                hi = a + int(np.searchsorted(run, scope, side="right"))
+            if hi > lo:
+                jobs.append((scope, month[a], lo, hi - lo))
+    for scope in scopes:
+        (OUTDIR / "enriched_monthly_all" / scope).mkdir(parents=True, exist_ok=True)
+        log(lambda: f"[write] {scope}: months={sum(1 for j in jobs if j[0] == scope)}")
+
+    def _write_one(job):
+        scope, month, off, n = job
+        year_dir = OUTDIR / "enriched_monthly_all" / scope / month[:4]
         year_dir.mkdir(parents=True, exist_ok=True)
-        out_path = year_dir / f"{month}.csv"
-        g.drop(columns=["month","year"], errors="ignore").to_csv(out_path, index=False)
-        log(f"[write] {scope} -> {out_path} (rows={len(g)})")
+        g = tbl.slice(off, n)
+        if PART_FORMAT == "csv":
+            out_path = year_dir / f"{month}.csv"
+            g.to_pandas().to_csv(out_path, index=False)
+        else:
+            out_path = year_dir / f"{month}.parquet"
+            pq.write_table(g, out_path, compression="zstd")
+        log(lambda: f"[write] {scope} -> {out_path} (rows={n})")
+
+    # partitions are independent files; overlap their encode/write latency
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as ex:
+        list(ex.map(_write_one, jobs))
 
 # Main
 def main():
@@ -480,16 +675,14 @@ def main():
     df = load_all()
     view = make_final_view(df)
 
-    write_monthly_partitions(view, "all")
-    write_monthly_partitions(view[view["source"]=="cispa"].copy(), "cispa")
-    write_monthly_partitions(view[view["source"]=="ynu"].copy(), "ynu")
+    write_monthly_partitions(view, SCOPES)
 
     log("----- SUMMARY -----")
     try:
-        log(view.groupby(["source","honeypot_type"]).size().rename("rows").to_string())
+        log(view.groupby(["source","honeypot_type"], observed=True).size().rename("rows").to_string())
     except Exception:
         pass
-    log(f"months written: {view['month'].nunique()}  total rows: {len(view)}")
+    log(lambda: f"months written: {view['month'].nunique()}  total rows: {len(view)}")
     log(f"TOTAL TIME: {time.time()-t0:.1f}s")
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@
 RDAP Enrichment with sharding and multi-threading:
 
 This script enriches monthly CSV partitions with RDAP metadata for source IPs, using sharding across processes and multi-threaded lookups per file.
+Lookups go straight to the RIR's RDAP server (IANA bootstrap) over keep-alive connections reused per worker thread.
 It applies a token-bucket rate limiter and exponential backoff, writes results to a JSONL cache via a dedicated append-only thread, 
 and can skip CDN/cloud infrastructure using ASN/domain/org heuristics. 
 For each IP it merges normalized RDAP fields (country, org/name, CIDR, RIR, error) back into the original rows 
@@ -14,18 +15,21 @@ with options to shard the workload (`SHARD_TOTAL/SHARD_IDX`) and skip files that
 Progress and errors are tracked in `_progress.jsonl` and `_errors.txt`, and retries can be enabled for failed or incomplete cache entries.
 
 Input:
-  PART_DIR/<YYYY>/<YYYY-MM>.csv or PART_DIR/*.csv
+  PART_DIR/<YYYY>/<YYYY-MM>.{parquet,csv} or PART_DIR/*.{parquet,csv}
 Output:
-  OUT_DIR/<YYYY>/<YYYY-MM>.csv
+  OUT_DIR/<YYYY>/<YYYY-MM>.parquet   (OUT_FORMAT=parquet, default; OUT_FORMAT=csv for .csv)
   (extra columns) rdap_ok, rdap_net_cc, rdap_org, rdap_cidr, rir, rdap_error, country_consensus, consensus_rule
 
 Environment examples:
   export RDAP_CACHE=out_amp_wartime/rdap_cache_v2.jsonl
   export OUT_DIR=out_amp_wartime/enriched_monthly_rdap/all_v2
   export SKIP_IF_EXISTS=0 RDAP_ONLY_RUUA=1
-  export RDAP_RETRY_BAD_CACHE=1 RDAP_RETRY_EMPTY_CC=1
-  export RDAP_WORKERS=64 RDAP_QPS=6 RDAP_BURST=24
-  export STRICT_ONLY=0 SHARD_TOTAL=4
+  export RDAP_SKIP_NON_RUUA=1   # or: RDAP only for MaxMind RU/UA + unknown-country IPs (GEOIP_COUNTRY if no countrycode)
+  export RDAP_RETRY_BAD_CACHE=1 RDAP_RETRY_EMPTY_CC=1 RDAP_CIDR_CACHE=0   # 1: answer IPs from cached covering networks
+  export RDAP_WORKERS=64 RDAP_QPS=6 RDAP_BURST=24   # per RDAP server; RDAP_QPS_MAX caps the adaptive rate
+  export RDAP_BOOTSTRAP=out_amp_wartime/rdap_bootstrap.json RDAP_TIMEOUT=12 RDAP_DNS_TTL=3600
+  export STRICT_ONLY=0 SHARD_TOTAL=4 MERGE_WORKERS=2 MERGE_BATCH_ROWS=262144
+  export OUT_FORMAT=parquet OUT_COLUMNS=all   # OUT_COLUMNS=added: only src + added columns (join on src)
 
 Sharded runs:
   SHARD_IDX=0 python3 rdap_enrichment.py
@@ -33,6 +37,14 @@ Sharded runs:
   SHARD_IDX=2 python3 rdap_enrichment.py
   SHARD_IDX=3 python3 rdap_enrichment.py
 
+  Each shard first resolves its bucket of the unique candidate IPs over *all* partitions
+  (crc32(ip) % SHARD_TOTAL, so an IP is queried by one shard only), then merges its files once the
+  other shards' buckets are in the cache (it stops waiting after RDAP_SHARD_WAIT seconds without new
+  cache entries and queries what is still missing itself).
+  To merge only once every bucket is in the cache, run the two phases separately:
+    RDAP_PHASE=lookup SHARD_IDX=<i> python3 rdap_enrichment.py   # all shards, network only
+    RDAP_PHASE=merge  SHARD_IDX=<i> python3 rdap_enrichment.py   # afterwards, no network
+
 Quickstart (single-process, no sharding):
   PART_DIR="out_amp_wartime/enriched_monthly/all" \
   OUT_DIR="out_amp_wartime/enriched_monthly_rdap/all" \
@@ -47,38 +59,66 @@ Output columns (added by this script):
   - `country_consensus` (resolved RU/UA label) and `consensus_rule` ∈ {strict, mm_only, rdap_only, conflict, no_ru_ua}
 """
 
-import os, time, json, sys, threading, re, random
-from queue import Queue
+import os, time, json, sys, threading, socket, re, random, zlib, functools, itertools, bisect, ipaddress, http.client, urllib.request
+from collections import deque
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 
+import numpy as np
 import pandas as pd
-from ipwhois import IPWhois
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
+try:
+    import orjson   # optional: faster cache parsing/serialization
+except ImportError:
+    orjson = None
+
+try:
+    from ipwhois import IPWhois   # optional: only for IPs outside the RDAP bootstrap
+except ImportError:
+    IPWhois = None
+
 # input and output configuration
 PART_DIR        = Path(os.environ.get("PART_DIR", "out_amp_wartime/enriched_monthly/all"))
 OUT_DIR         = Path(os.environ.get("OUT_DIR",  "out_amp_wartime/enriched_monthly_rdap/all")); OUT_DIR.mkdir(parents=True, exist_ok=True)
 RDAP_CACHE      = Path(os.environ.get("RDAP_CACHE", "out_amp_wartime/rdap_cache.jsonl"))
+OUT_FORMAT      = os.environ.get("OUT_FORMAT", "parquet").strip().lower()   # parquet | csv
+OUT_COLUMNS     = os.environ.get("OUT_COLUMNS", "all").strip().lower()     # all | added (src + RDAP/consensus columns)
+RDAP_BOOTSTRAP  = Path(os.environ.get("RDAP_BOOTSTRAP", str(RDAP_CACHE.parent / "rdap_bootstrap.json")))
 
 # RDAP lookup behavior
 RDAP_WORKERS    = int(os.environ.get("RDAP_WORKERS", "48"))
-RDAP_QPS        = float(os.environ.get("RDAP_QPS", "12"))         
+RDAP_QPS        = float(os.environ.get("RDAP_QPS", "12"))          # starting rate per RDAP server
+RDAP_QPS_MAX    = float(os.environ.get("RDAP_QPS_MAX", str(RDAP_QPS * 4)))   # ceiling for the adaptive rate
 RDAP_BURST      = int(os.environ.get("RDAP_BURST", "36"))          
 RDAP_BUDGET     = int(os.environ.get("RDAP_BUDGET", "0"))          
+RDAP_TIMEOUT    = float(os.environ.get("RDAP_TIMEOUT", "12"))
+RDAP_DNS_TTL    = float(os.environ.get("RDAP_DNS_TTL", "3600"))   # seconds an RDAP host's address is reused; 0 = resolve per connection
 
 # RDAP cache and retry settings
 RDAP_RETRY_BAD_CACHE = int(os.environ.get("RDAP_RETRY_BAD_CACHE", "1"))
 RDAP_RETRY_EMPTY_CC  = int(os.environ.get("RDAP_RETRY_EMPTY_CC", "1"))  
+RDAP_CIDR_CACHE      = int(os.environ.get("RDAP_CIDR_CACHE", "0"))   # opt-in: reuse a cached answer for every IP inside its rdap_cidr
 
 # filtering and labeling options
 RDAP_ONLY_RUUA  = int(os.environ.get("RDAP_ONLY_RUUA", "0"))
+RDAP_SKIP_NON_RUUA = int(os.environ.get("RDAP_SKIP_NON_RUUA", "0"))  # RDAP only for MaxMind RU/UA or unknown country
+GEOIP_COUNTRY   = os.environ.get("GEOIP_COUNTRY")   # MaxMind country MMDB, used when the input has no countrycode
 STRICT_ONLY     = int(os.environ.get("STRICT_ONLY", "0"))
 
 # sharding and parallel execution
 SHARD_TOTAL     = int(os.environ.get("SHARD_TOTAL", "1"))
 SHARD_IDX       = int(os.environ.get("SHARD_IDX", "0"))
+RDAP_PHASE      = os.environ.get("RDAP_PHASE", "all").strip().lower()   # all | lookup | merge
+RDAP_SHARD_WAIT = float(os.environ.get("RDAP_SHARD_WAIT", "300"))   # phase all: seconds without new cache entries before a shard stops waiting for the others' buckets
 SKIP_IF_EXISTS  = int(os.environ.get("SKIP_IF_EXISTS", "1"))
+MERGE_WORKERS   = int(os.environ.get("MERGE_WORKERS", "2"))   # files read/merged/written concurrently
+MERGE_BATCH_ROWS = int(os.environ.get("MERGE_BATCH_ROWS", "262144"))   # rows per merge/write batch; 0 = whole file
 
 # CDN / cloud exclusion
 CDN_EXCLUDE     = int(os.environ.get("CDN_EXCLUDE", "1"))
@@ -98,6 +138,8 @@ try:
     CDN_ASNS = {int(x) for x in _env_asns} if _env_asns else set(_DEFAULT_CDN_ASNS)
 except Exception:
     CDN_ASNS = set(_DEFAULT_CDN_ASNS)
+# sorted once for np.isin; int64 because 4-byte ASNs exceed the int32 range
+_CDN_ASNS_NP = np.sort(np.fromiter(CDN_ASNS, dtype=np.int64))
 
 # default CDN/Cloud domain keywords (can be expanded)
 _DEFAULT_DOMAIN_KEYS = [
@@ -126,27 +168,200 @@ def _tqdm_disable_default():
     return TQDM_DISABLE or (not sys.stdout.isatty())
 
 def log(msg: str):
-    print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+    # one write per line so messages from merge threads do not interleave
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}\n", end="", flush=True)
+
+RDAP_COLS = ["rdap_ok", "rdap_net_cc", "rdap_org", "rdap_cidr", "rir", "rdap_error",
+             "country_consensus", "consensus_rule"]
+
+# fixed output types of the added columns, so every batch of a file is written with one schema
+RDAP_TYPES = {"rdap_ok": pa.bool_(), "rdap_net_cc": pa.string(), "rdap_org": pa.string(),
+              "rdap_cidr": pa.string(), "rir": pa.string(), "rdap_error": pa.string(),
+              "country_consensus": pa.string()}
 
-def write_atomic(path: Path, df: pd.DataFrame):
-    # atomic write: write to .tmp then move
+def _out_schema(schema: pa.Schema) -> pa.Schema:
+    # schema of the first batch, generalized so that later batches cast to it
+    fields = []
+    for f in schema:
+        t = RDAP_TYPES.get(f.name, f.type)
+        if pa.types.is_null(t):
+            t = pa.string()
+        elif pa.types.is_dictionary(t):
+            t = pa.dictionary(pa.int32(), t.value_type)   # index width varies with each batch's categories
+        fields.append(f.with_type(t))
+    return pa.schema(fields, metadata=schema.metadata)
+
+def _csv_columns(tbl: pa.Table, narrow: dict) -> pa.Table:
+    # values written as pandas writes them where Arrow differs: booleans as True/False (not true/false);
+    # whole-second timestamps as "YYYY-MM-DD HH:MM:SS", not with 9 fractional digits, while every batch
+    # of the file so far fits in seconds (from the first that does not, the source unit)
+    for i, f in enumerate(tbl.schema):
+        if pa.types.is_boolean(f.type):
+            tbl = tbl.set_column(i, f.name, pc.if_else(tbl.column(i), "True", "False"))
+        elif pa.types.is_timestamp(f.type) and narrow.setdefault(f.name, f.type.unit != "s"):
+            try:
+                tbl = tbl.set_column(i, f.name, tbl.column(i).cast(pa.timestamp("s", f.type.tz)))
+            except pa.ArrowInvalid:
+                narrow[f.name] = False
+    return tbl
+
+def write_atomic(path: Path, frames) -> int:
+    # atomic write of a DataFrame or an iterable of DataFrame batches: write to .tmp then move
+    # (Parquet+zstd or CSV, by suffix); returns the number of rows written
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
     tmp = Path(str(path) + ".tmp")
-    df.to_csv(tmp, index=False)
+    csv = path.suffix != ".parquet"
+    writer, rows, narrow = None, 0, {}
+    try:
+        for df in frames:
+            tbl = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                schema = _out_schema(tbl.schema)
+            tbl = tbl.cast(schema)   # ArrowInvalid here: a batch does not fit the first batch's types
+            if writer is None:
+                writer = pa.OSFile(str(tmp), "wb") if csv else pq.ParquetWriter(tmp, schema, compression="zstd")
+            if csv:
+                # one write_csv per batch: the timestamp unit may differ between batches (_csv_columns)
+                pacsv.write_csv(_csv_columns(tbl, narrow), writer,
+                                pacsv.WriteOptions(include_header=writer.tell() == 0, quoting_style="needed"))
+            else:
+                writer.write_table(tbl)
+            rows += tbl.num_rows
+        writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        tmp.unlink(missing_ok=True)
+        raise
     os.replace(tmp, path)
+    return rows
+
+# CSV partitions are parsed by Arrow (multi-threaded); low-cardinality columns come back as categoricals
+CSV_COLUMN_TYPES = {
+    "src": pa.string(), "target": pa.string(),
+    "countrycode": pa.dictionary(pa.int32(), pa.string()),
+    "domain": pa.dictionary(pa.int32(), pa.string()),
+}
+CSV_PARSE_OPTIONS = pacsv.ParseOptions(invalid_row_handler=lambda row: "skip")
+
+def _csv_convert_options(columns: list = None):
+    return pacsv.ConvertOptions(column_types=CSV_COLUMN_TYPES, strings_can_be_null=True,
+                                include_columns=columns)
 
-def load_cache(path: Path) -> dict:
-    # load JSONL cache into memory {ip: data}
+def read_table(path: Path, columns: list = None) -> pa.Table:
+    # `columns`: read only these (when present in the file)
+    read_options = pacsv.ReadOptions(use_threads=True, block_size=64 << 20)
+    if columns is not None:
+        names = (pq.read_schema(path).names if path.suffix == ".parquet"
+                 else pacsv.open_csv(path, read_options=read_options).schema.names)
+        columns = [c for c in columns if c in names]
+    if path.suffix == ".parquet":
+        return pq.read_table(path, columns=columns)
+    return pacsv.read_csv(path, read_options=read_options, parse_options=CSV_PARSE_OPTIONS,
+                          convert_options=_csv_convert_options(columns))
+
+def iter_tables(path: Path, batch_rows: int):
+    # partition as a stream of tables of about `batch_rows` rows (at least one, possibly empty)
+    if batch_rows <= 0:
+        yield read_table(path)
+        return
+    if path.suffix == ".parquet":
+        pf = pq.ParquetFile(path)
+        batches, schema = pf.iter_batches(batch_size=batch_rows), pf.schema_arrow
+    else:
+        # CSV batches are blocks of bytes: ~64 bytes per row keeps them near batch_rows.
+        # Column types come from the first block (a later mismatch raises ArrowInvalid);
+        # columns that are empty there are read as strings
+        read_options = pacsv.ReadOptions(use_threads=True, block_size=max(1 << 20, batch_rows * 64))
+        first = pacsv.open_csv(path, read_options=read_options, parse_options=CSV_PARSE_OPTIONS,
+                               convert_options=_csv_convert_options()).schema
+        convert = _csv_convert_options()
+        convert.column_types = {**{f.name: pa.string() for f in first if pa.types.is_null(f.type)},
+                                **CSV_COLUMN_TYPES}
+        batches = pacsv.open_csv(path, read_options=read_options, parse_options=CSV_PARSE_OPTIONS,
+                                 convert_options=convert)
+        schema = batches.schema
+    empty = True
+    for b in batches:
+        empty = False
+        yield pa.Table.from_batches([b])
+    if empty:
+        yield schema.empty_table()
+
+def to_pandas(tbl: pa.Table) -> pd.DataFrame:
+    return tbl.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+_json_loads = orjson.loads if orjson else json.loads
+_CACHE_IP_RE = re.compile(rb'\{"ip":\s*"([^"]*)"')   # leading key as written by cache_writer_thread
+
+def load_cache(path: Path, keep=None) -> dict:
+    # load JSONL cache into memory {ip: data}; with `keep` (set of IPs) only those entries are held,
+    # and of the others only networks covering an IP of `keep` feed the CIDR index (RDAP_CIDR_CACHE)
     d = {}
+    within = _ip_ints(keep) if keep is not None and RDAP_CIDR_CACHE else None
     if path.exists():
-        with path.open("r", encoding="utf-8") as f:
+        with path.open("rb") as f:
             for line in f:
+                if keep is not None and not RDAP_CIDR_CACHE:
+                    # skip unwanted entries without parsing them
+                    m = _CACHE_IP_RE.match(line)
+                    if m and m.group(1).decode() not in keep:
+                        continue
                 try:
-                    o = json.loads(line)
-                    d[str(o["ip"])] = o["data"]
+                    o = _json_loads(line)
+                    ip = str(o["ip"])
+                    if keep is None or ip in keep:
+                        d[ip] = o["data"]
+                    elif RDAP_CIDR_CACHE and o["data"].get("ok"):
+                        _cidr_add(o["data"], within)
                 except Exception:
                     pass
     return d
 
+# CIDR-level view of the cache: {(ip version, prefixlen): {network int: data}}
+_cidr_index = {}
+
+def _ip_ints(ips) -> dict:
+    # {ip version: sorted integer addresses} of `ips`, to test network coverage with bisect
+    out = {4: [], 6: []}
+    for ip in ips:
+        try:
+            a = ipaddress.ip_address(ip)
+        except ValueError:
+            continue
+        out[a.version].append(int(a))
+    return {v: sorted(x) for v, x in out.items()}
+
+def _cidr_add(data: dict, within: dict = None):
+    # index an ok RDAP answer under each network of its rdap_cidr ("a/n, b/m");
+    # with `within` (from _ip_ints) only networks that cover at least one of those IPs
+    for c in (data.get("rdap_cidr") or "").split(","):
+        try:
+            net = ipaddress.ip_network(c.strip(), strict=False)
+        except ValueError:
+            continue
+        if within is not None:
+            xs = within[net.version]
+            i = bisect.bisect_left(xs, int(net.network_address))
+            if i == len(xs) or xs[i] > int(net.broadcast_address):
+                continue
+        _cidr_index.setdefault((net.version, net.prefixlen), {})[int(net.network_address)] = data
+
+def _cidr_lookup(ip: str):
+    # most specific cached network covering `ip`, or None
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    n, bits = int(addr), addr.max_prefixlen
+    for v, plen in sorted(_cidr_index, key=lambda k: -k[1]):
+        if v == addr.version:
+            hit = _cidr_index[(v, plen)].get(n >> (bits - plen) << (bits - plen))
+            if hit:
+                return hit
+    return None
+
 # fcntl file locks (no-op on platforms without fcntl)
 try:
     import fcntl
@@ -157,18 +372,41 @@ except Exception:
     def _unlock(f): return None
 
 # dedicated async cache writer (append-only JSONL)
-_cache_q = Queue(maxsize=10000)
+# hand-off is a deque (append/popleft are atomic) plus an Event to wake the writer: no per-record lock/condition
+_cache_dq = deque()
+_cache_ev = threading.Event()
+CACHE_BATCH   = 256    # records per write
+CACHE_FLUSH_S = 0.05   # max time a record waits for its batch
+
+def cache_put(ip: str, data: dict):
+    _cache_dq.append((ip, data))
+    _cache_ev.set()
+
 def cache_writer_thread(path: Path, stop_evt: threading.Event):
-    f = path.open("a", encoding="utf-8")
+    # one lock + write + flush per batch of up to CACHE_BATCH records (or CACHE_FLUSH_S), not per record
+    f = path.open("ab")
     try:
-        while not stop_evt.is_set() or not _cache_q.empty():
-            try:
-                ip, data = _cache_q.get(timeout=0.2)
-            except Exception:
+        while not stop_evt.is_set() or _cache_dq:
+            if not _cache_dq:
+                _cache_ev.wait(timeout=CACHE_FLUSH_S)
+            _cache_ev.clear()
+            buf = []
+            while len(buf) < CACHE_BATCH:
+                try:
+                    buf.append(_cache_dq.popleft())
+                except IndexError:
+                    break
+            if not buf:
                 continue
+            if orjson:
+                lines = b"".join(orjson.dumps({"ip": ip, "data": data}, option=orjson.OPT_APPEND_NEWLINE)
+                                 for ip, data in buf)
+            else:
+                lines = "".join(json.dumps({"ip": ip, "data": data}, ensure_ascii=False) + "\n"
+                                for ip, data in buf).encode("utf-8")
             try:
                 _lock(f)
-                f.write(json.dumps({"ip": ip, "data": data}, ensure_ascii=False) + "\n")
+                f.write(lines)
                 f.flush()
             finally:
                 try: _unlock(f)
@@ -206,53 +444,246 @@ def _lookup_rdap_compat(ip: str, *, asn_methods=None, timeout=12,
             continue
     raise TypeError(last_err or "lookup_rdap signature not supported")
 
-# token bucket state
+# direct RDAP-over-HTTPS client (IANA bootstrap → RIR endpoint, keep-alive connections)
+IANA_BOOTSTRAP_URLS = {"ipv4": "https://data.iana.org/rdap/ipv4.json",
+                       "ipv6": "https://data.iana.org/rdap/ipv6.json"}
+_RIR_BY_HOST = {"rdap.arin.net": "arin", "rdap.db.ripe.net": "ripencc", "rdap.apnic.net": "apnic",
+                "rdap.lacnic.net": "lacnic", "rdap.afrinic.net": "afrinic"}
+_rdap_bootstrap = []   # [(ip_network, base_url)], filled once in main()
+_boot_index = {}       # version -> (starts, max_end_so_far, ends, bases), sorted by start
+
+def load_bootstrap(path: Path) -> list:
+    """
+    IANA RDAP bootstrap as [(ip_network, base_url)]. Downloaded once and kept at `path`
+    (delete the file to refresh). Returns [] when it cannot be fetched; lookups then go through ipwhois (if installed).
+    """
+    try:
+        if path.exists():
+            doc = json.loads(path.read_text(encoding="utf-8"))
+        else:
+            doc = {}
+            for k, url in IANA_BOOTSTRAP_URLS.items():
+                with urllib.request.urlopen(url, timeout=RDAP_TIMEOUT) as r:
+                    doc[k] = json.load(r)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = Path(str(path) + ".tmp")
+            tmp.write_text(json.dumps(doc), encoding="utf-8")
+            os.replace(tmp, path)
+    except Exception as e:
+        log(f"[bootstrap] unavailable ({e}); falling back to ipwhois lookups")
+        return []
+    table = []
+    for k in IANA_BOOTSTRAP_URLS:
+        for nets, urls in (doc.get(k) or {}).get("services", []):
+            base = next((u for u in urls if u.startswith("https://")), urls[0]).rstrip("/")
+            table.extend((ipaddress.ip_network(n), base) for n in nets)
+    return table
+
+def index_bootstrap(table: list):
+    # per IP version: ranges sorted by (start, least specific first) for bisect, so walking back from the
+    # bisect point meets the most specific range first; the running max of range ends bounds that walk
+    _boot_index.clear()
+    for v in (4, 6):
+        nets = sorted(((int(n.network_address), -n.prefixlen, int(n.broadcast_address), b)
+                       for n, b in table if n.version == v), key=lambda t: (t[0], -t[1]))
+        ends = [t[2] for t in nets]
+        _boot_index[v] = ([t[0] for t in nets], list(itertools.accumulate(ends, max)), ends, [t[3] for t in nets])
+
+def _rdap_base(ip: str):
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    starts, max_end, ends, bases = _boot_index.get(addr.version) or ([], [], [], [])
+    a = int(addr)
+    i = bisect.bisect_right(starts, a) - 1
+    while i >= 0 and max_end[i] >= a:
+        if ends[i] >= a:
+            return bases[i]
+        i -= 1
+    return None
+
+class RateLimited(RuntimeError):
+    def __init__(self, msg: str, retry_after=None):
+        super().__init__(msg)
+        try:
+            self.retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            self.retry_after = None   # HTTP-date form: fall back to exponential backoff
+
+# one keep-alive connection per (worker thread, host): TCP/TLS/DNS setup is paid once, not per IP
+_http_local = threading.local()
+
+# RDAP hosts resolved once per RDAP_DNS_TTL and shared by all workers; Host header and TLS SNI keep the name
+_dns_lock = threading.Lock()
+_dns_cache = {}   # (host, port) -> (addr, expires)
+
+def _resolve(host: str, port: int) -> str:
+    now = time.monotonic()
+    with _dns_lock:
+        hit = _dns_cache.get((host, port))
+    if hit and hit[1] > now:
+        return hit[0]
+    addr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+    with _dns_lock:
+        _dns_cache[(host, port)] = (addr, now + RDAP_DNS_TTL)
+    return addr
+
+def _pinned_create_connection(address, *a, **kw):
+    host, port = address
+    try:
+        return socket.create_connection((_resolve(host, port), port), *a, **kw)
+    except OSError:
+        # stale or unreachable address: forget it and let the resolver pick again
+        with _dns_lock:
+            _dns_cache.pop((host, port), None)
+        return socket.create_connection(address, *a, **kw)
+
+def _http_conn(scheme: str, netloc: str):
+    cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    conn = cls(netloc, timeout=RDAP_TIMEOUT)
+    if RDAP_DNS_TTL > 0:
+        conn._create_connection = _pinned_create_connection
+    return conn
+
+def _http_get_json(url: str, redirects: int = 3):
+    u = urlsplit(url)
+    pool = _http_local.__dict__.setdefault("conns", {})
+    key = (u.scheme, u.netloc)
+    for attempt in (0, 1):
+        conn = pool.get(key)
+        if conn is None:
+            conn = pool[key] = _http_conn(u.scheme, u.netloc)
+        try:
+            conn.request("GET", u.path + (f"?{u.query}" if u.query else ""),
+                         headers={"Accept": "application/rdap+json"})
+            resp = conn.getresponse()
+            body = resp.read()
+            break
+        except (http.client.HTTPException, OSError):
+            # server closed an idle keep-alive connection: reconnect once
+            conn.close(); pool.pop(key, None)
+            if attempt:
+                raise
+    if resp.status in (301, 302, 303, 307, 308) and redirects and resp.getheader("Location"):
+        return _http_get_json(urljoin(url, resp.getheader("Location")), redirects - 1)
+    if resp.status == 429:
+        raise RateLimited(f"HTTP 429 Too Many Requests ({u.netloc})", resp.getheader("Retry-After"))
+    if resp.status != 200:
+        raise RuntimeError(f"HTTP {resp.status} for {url}")
+    return json.loads(body), url
+
+def _rdap_net_cidr(net: dict):
+    cidrs = [f"{c.get('v4prefix') or c.get('v6prefix')}/{c['length']}"
+             for c in net.get("cidr0_cidrs") or [] if c.get("length") is not None]
+    if not cidrs and net.get("startAddress") and net.get("endAddress"):
+        try:
+            cidrs = [str(n) for n in ipaddress.summarize_address_range(
+                ipaddress.ip_address(net["startAddress"]), ipaddress.ip_address(net["endAddress"]))]
+        except Exception:
+            pass
+    return ", ".join(cidrs) or None
+
+def _lookup_rdap_direct(ip: str, base: str) -> dict:
+    # GET <rir>/ip/<ip>; returns the subset of ipwhois' lookup_rdap() shape used by rdap_lookup()
+    net, url = _http_get_json(f"{base}/ip/{ip}")
+    return {
+        "network": {"country": net.get("country"), "name": net.get("name"), "cidr": _rdap_net_cidr(net)},
+        "asn_registry": _RIR_BY_HOST.get(urlsplit(url).hostname),
+    }
+
+# token buckets, one per RDAP server (bootstrap base URL host; "ipwhois" for the fallback).
+# Each adapts its rate (AIMD): x0.75 on a 429, x1.1 after RATE_UP_AFTER successes in a row, within
+# [RATE_MIN_QPS, RDAP_QPS_MAX], so one strict RIR does not throttle the others
+RATE_UP_AFTER = 50
+RATE_MIN_QPS = 0.5
+RATE_LOG_S = 60.0
 _tb_lock = threading.Lock()
-_tb_tokens = float(RDAP_BURST)
-_tb_last = time.monotonic()
+_buckets = {}   # key -> {"tokens", "last", "qps", "ok_run", "logged"}
+
+def _bucket(key: str) -> dict:
+    b = _buckets.get(key)
+    if b is None:
+        b = _buckets[key] = {"tokens": float(RDAP_BURST), "last": time.monotonic(),
+                             "qps": RDAP_QPS, "ok_run": 0, "logged": 0.0}
+    return b
 
-def _rate_limit_token_bucket():
+def _rate_limit_token_bucket(key: str):
     # consume one token or return required wait time if insufficient tokens
-    global _tb_tokens, _tb_last
     now = time.monotonic()
     with _tb_lock:
-        add = (now - _tb_last) * RDAP_QPS
+        b = _bucket(key)
+        add = (now - b["last"]) * b["qps"]
         if add > 0:
-            _tb_tokens = min(RDAP_BURST, _tb_tokens + add)
-            _tb_last = now
-        if _tb_tokens >= 1.0:
-            _tb_tokens -= 1.0
+            b["tokens"] = min(RDAP_BURST, b["tokens"] + add)
+            b["last"] = now
+        if b["tokens"] >= 1.0:
+            b["tokens"] -= 1.0
             return 0.0
-        need = 1.0 - _tb_tokens
-        wait = need / RDAP_QPS
+        need = 1.0 - b["tokens"]
+        wait = need / b["qps"]
     return max(0.0, wait)
 
-def _with_backoff(func, *a, **kw):
-    # simple exponential backoff for rate-limit-like errors
+def _rate_feedback(key: str, limited: bool):
+    # AIMD on the bucket's rate; changes are journaled at most every RATE_LOG_S per server
+    with _tb_lock:
+        b = _bucket(key)
+        old = b["qps"]
+        if limited:
+            b["qps"] = max(RATE_MIN_QPS, old * 0.75)
+            b["ok_run"] = 0
+        else:
+            b["ok_run"] += 1
+            if b["ok_run"] >= RATE_UP_AFTER:
+                b["qps"] = min(RDAP_QPS_MAX, old * 1.1)
+                b["ok_run"] = 0
+        now = time.monotonic()
+        if b["qps"] == old or now - b["logged"] < RATE_LOG_S:
+            return
+        b["logged"] = now
+        qps = round(b["qps"], 2)
+    append_progress({"rdap_server": key, "qps": qps})
+
+def _throttle(key: str):
+    wait = _rate_limit_token_bucket(key)
+    if wait > 0:
+        time.sleep(wait)
+
+def _with_backoff(key: str, func, *a, **kw):
+    # exponential backoff (or the server's Retry-After) for rate-limit-like errors;
+    # every attempt takes a token from the server's bucket and reports back to it
     delay = 0.5
     for _ in range(6):
+        _throttle(key)
         try:
-            return func(*a, **kw)
+            r = func(*a, **kw)
         except Exception as e:
             msg = str(e).lower()
             if "429" in msg or "rate" in msg or "too many" in msg:
-                time.sleep(delay + random.random()*delay*0.2)
+                _rate_feedback(key, True)
+                time.sleep(max(delay + random.random()*delay*0.2, getattr(e, "retry_after", None) or 0))
                 delay = min(delay*2, 16)
                 continue
             raise
+        _rate_feedback(key, False)
+        return r
+    _throttle(key)
     return func(*a, **kw)
 
 def rdap_lookup(ip: str) -> dict:
-    # RDAP lookup with rate-limit + backoff; return normalized dict
+    # RDAP lookup with per-server rate-limit + backoff; return normalized dict
     try:
-        wait = _rate_limit_token_bucket()
-        if wait > 0:
-            time.sleep(wait)
-        r = _with_backoff(
-            _lookup_rdap_compat,
-            ip, asn_methods=['http','whois'],
-            timeout=12, retry_count=1, rate_limit_timeout=60
-        )
+        base = _rdap_base(ip)
+        if base:
+            r = _with_backoff(urlsplit(base).netloc, _lookup_rdap_direct, ip, base)
+        elif IPWhois is None:
+            raise LookupError("no RDAP bootstrap entry (install ipwhois for the fallback)")
+        else:
+            r = _with_backoff(
+                "ipwhois", _lookup_rdap_compat,
+                ip, asn_methods=['http','whois'],
+                timeout=RDAP_TIMEOUT, retry_count=1, rate_limit_timeout=60
+            )
         net = r.get("network") or {}
         return {
             "ok": True,
@@ -264,93 +695,171 @@ def rdap_lookup(ip: str) -> dict:
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
-def _norm_cc_series(s: pd.Series) -> pd.Series:
-    s = s.astype("string").str.upper()
-    return s.where(~s.isin(["", "NA", "N/A", "NONE", "NULL", "NAN"]), "")
+def _ruua_codes(s) -> np.ndarray:
+    # int8 country codes: 1=RU, 2=UA, 0=anything else (case-insensitive; computed per distinct value)
+    if s is None:
+        return np.zeros(0, dtype=np.int8)
+    codes, uniq = pd.factorize(s)
+    u = pd.Index(uniq).astype("string").str.upper()
+    lut = np.select([u == "RU", u == "UA"], [1, 2], 0).astype(np.int8)
+    return np.append(lut, np.int8(0))[codes]
 
 _cdn_dom_re = re.compile("|".join(map(re.escape, CDN_DOMAIN_KEYS)), re.I)
 _cdn_org_re = re.compile("|".join(map(re.escape, CDN_ORG_KEYS)), re.I)
 
-def exclude_cdn(df: pd.DataFrame) -> pd.DataFrame:
-    dom = df.get("domain")
-    if dom is None:
-        m_dom = pd.Series(False, index=df.index)
-    else:
-        m_dom = dom.astype("string", copy=False).str.contains(_cdn_dom_re, na=False)
-    asn = df.get("asnum")
-    if asn is None:
-        m_asn = pd.Series(False, index=df.index)
-    else:
-        m_asn = pd.to_numeric(asn, errors="coerce").astype("Int64").isin(pd.Series(list(CDN_ASNS), dtype="Int64"))
-    org_cols = [c for c in ("asorg","org","isp","rdap_org") if c in df.columns]
-    if org_cols:
-        joined = df[org_cols].astype("string").fillna("").agg(" ".join, axis=1)
-        m_org = joined.str.contains(_cdn_org_re, na=False)
-    else:
-        m_org = pd.Series(False, index=df.index)
-    mask = ~(m_dom | m_asn | m_org)
-    return df.loc[mask].copy()
+try:
+    import ahocorasick
+except Exception:
+    ahocorasick = None
 
-def consensus_cols(out: pd.DataFrame, strict: bool):
-    # compute (country_consensus, consensus rule) for RU/UA
-    mm = _norm_cc_series(out.get("countrycode")) if "countrycode" in out.columns else pd.Series("", index=out.index)
-    rd = _norm_cc_series(out.get("rdap_net_cc"))
+def _keyword_matcher(keys: list, rx: re.Pattern):
+    # str -> bool: any keyword is a substring (case-insensitive); Aho-Corasick automaton if pyahocorasick is installed
+    if ahocorasick is None:
+        return lambda v: rx.search(v) is not None
+    A = ahocorasick.Automaton()
+    for k in keys:
+        A.add_word(k, k)
+    A.make_automaton()
+    return lambda v: next(A.iter(v.lower()), None) is not None
+
+_cdn_dom_match = _keyword_matcher(CDN_DOMAIN_KEYS, _cdn_dom_re)
+_cdn_org_match = _keyword_matcher(CDN_ORG_KEYS, _cdn_org_re)
 
-    cons = pd.Series(index=out.index, dtype="object")                 
-    rule = pd.Series("no_ru_ua", index=out.index, dtype="string")
+def _contains_any(col: pa.ChunkedArray, match) -> np.ndarray:
+    # match each distinct value once (dictionary-encode) and broadcast back by index (null -> False)
+    arr = col.combine_chunks()
+    if not pa.types.is_dictionary(arr.type):
+        arr = pc.dictionary_encode(arr if pa.types.is_string(arr.type) else pc.cast(arr, pa.string()))
+    uniq = arr.dictionary.to_pylist()
+    hit = np.fromiter((v is not None and match(v) for v in uniq), dtype=bool, count=len(uniq))
+    idx = pc.fill_null(arr.indices, len(uniq)).to_numpy(zero_copy_only=False)
+    return np.append(hit, False)[idx]
 
-    # 1) 'strict': both in RU/UA and equal
-    m_both   = mm.isin(RUUA) & rd.isin(RUUA)
-    m_strict = m_both & (mm == rd)
-    cons[m_strict] = mm[m_strict].map(RUUA)
-    rule[m_strict] = "strict"
+def exclude_cdn(tbl: pa.Table) -> pa.Table:
+    # runs on the Arrow table, before pandas conversion: CDN rows are never materialized
+    names = tbl.column_names
+    mask = np.zeros(tbl.num_rows, dtype=bool)
+    if "domain" in names:
+        mask |= _contains_any(tbl["domain"], _cdn_dom_match)
+    if "asnum" in names:
+        asn = tbl["asnum"]
+        if pa.types.is_integer(asn.type):
+            asn = pc.fill_null(pc.cast(asn, pa.int64()), -1).to_numpy()
+        else:
+            asn = pd.to_numeric(asn.to_pandas(), errors="coerce").fillna(-1).to_numpy(dtype=np.int64)
+        mask |= np.isin(asn, _CDN_ASNS_NP)
+    for c in ("asorg", "org", "isp", "rdap_org"):
+        if c in names:
+            mask |= _contains_any(tbl[c], _cdn_org_match)
+    return tbl.filter(pa.array(~mask))
 
-    if strict:
-        return cons, rule
+CONSENSUS_NAMES = np.array([np.nan, "Russia", "Ukraine"], dtype=object)   # indexed by _ruua_codes
+CONSENSUS_RULES = ["strict", "conflict", "mm_only", "rdap_only", "no_ru_ua"]
 
-    # 2) conflict: both RU/UA but different
-    m_conflict = m_both & (mm != rd)
-    rule[m_conflict] = "conflict"
+# decision tables indexed by mm*3 + rd (codes from _ruua_codes: 0=other, 1=RU, 2=UA):
+# strict > conflict (both RU/UA, different) > mm_only (CSV says RU/UA) > rdap_only (RDAP says RU/UA)
+#                            rd: 0 1 2 | 0 1 2 | 0 1 2     (mm = 0 | 1 | 2)
+_CONS_CODE        = np.array([0, 1, 2,  1, 1, 0,  2, 0, 2], dtype=np.int8)
+_CONS_RULE        = np.array([4, 3, 3,  2, 0, 1,  2, 1, 0], dtype=np.int8)
+# 'strict' only: both in RU/UA and equal
+_CONS_CODE_STRICT = np.array([0, 0, 0,  0, 1, 0,  0, 0, 2], dtype=np.int8)
+_CONS_RULE_STRICT = np.array([4, 4, 4,  4, 0, 4,  4, 4, 0], dtype=np.int8)
 
-    # 3) mm_only: only CSV says RU/UA
-    m_mm = mm.isin(RUUA) & ~m_strict & ~m_conflict
-    cons[m_mm]  = mm[m_mm].map(RUUA)
-    rule[m_mm]  = "mm_only"
+def consensus_cols(out: pd.DataFrame, strict: bool):
+    # compute (country_consensus, consensus rule) for RU/UA: one table lookup per row
+    mm = _ruua_codes(out["countrycode"]) if "countrycode" in out.columns else np.zeros(len(out), dtype=np.int8)
+    rd = _ruua_codes(out["rdap_net_cc"])
 
-    # 4) rdap_only: only RDAP says RU/UA 
-    m_rd = rd.isin(RUUA) & ~m_strict & ~m_conflict & ~m_mm
-    cons[m_rd]  = rd[m_rd].map(RUUA)
-    rule[m_rd]  = "rdap_only"
+    k = mm * np.int8(3) + rd
+    code = (_CONS_CODE_STRICT if strict else _CONS_CODE)[k]
+    rule = (_CONS_RULE_STRICT if strict else _CONS_RULE)[k]
 
+    cons = pd.Series(CONSENSUS_NAMES[code], index=out.index, dtype="object")
+    rule = pd.Series(pd.Categorical.from_codes(rule, categories=CONSENSUS_RULES), index=out.index)
     return cons, rule
 
-def process_csv(path: Path, cache: dict) -> pd.DataFrame:
-    # per-file pipeline:
-    # 1) read_csv 2) CDN exclusion 3) decide RDAP IPs 4) parallel RDAP 5) merge + consensus
-    df = pd.read_csv(path, engine="c", low_memory=False, encoding="utf-8", on_bad_lines="skip")
+# columns needed to pick the RDAP candidate IPs of a partition (lookup phase)
+CANDIDATE_COLS = ["src", "target", "countrycode", "domain", "asnum", "asorg", "org", "isp"]
+
+def _to_frame(tbl: pa.Table) -> pd.DataFrame:
+    # (CDN-filtered) Arrow table -> DataFrame with `src` and an integer `asnum`
+    df = to_pandas(tbl)
 
     if "src" not in df.columns and "target" in df.columns:
         df["src"] = df["target"]
     
-    if "asnum" in df.columns:
+    if "asnum" in df.columns and not pd.api.types.is_integer_dtype(df["asnum"]):
+        # only when Arrow could not read it as integers (junk values, or all-null)
         df["asnum"] = pd.to_numeric(df["asnum"], errors="coerce").astype("Int64")
+    return df
 
+def _prepare(path: Path, columns: list = None):
+    # read partition, CDN exclusion, candidate IPs -> (df, ips)
+    tbl = read_table(path, columns)
     if CDN_EXCLUDE:
-        before = len(df)
-        df = exclude_cdn(df)
-        log(f"[CDN] {path.name}: excluded {before - len(df):,} rows (remain {len(df):,})")
-
-    # build unique candidate IP list
-    ips = list({str(x) for x in df["src"].dropna().astype(str).unique()})
+        before = tbl.num_rows
+        tbl = exclude_cdn(tbl)
+        log(f"[CDN] {path.name}: excluded {before - tbl.num_rows:,} rows (remain {tbl.num_rows:,})")
+    df = _to_frame(tbl)
 
-    # restrict to RU/UA candidates
+    # build unique candidate IP list (restricted to RU/UA candidates if requested)
+    src = df["src"]
     if RDAP_ONLY_RUUA and "countrycode" in df.columns:
-        cand = set(df.loc[df["countrycode"].astype("string").str.upper().isin(["RU","UA"]), "src"].astype(str))
-        ips = [ip for ip in ips if ip in cand]
+        src = src[_ruua_codes(df["countrycode"]) > 0]
+    elif RDAP_SKIP_NON_RUUA:
+        # MaxMind already settles IPs with a known non-RU/UA country: they can only end up
+        # rdap_only/no_ru_ua, never strict; RU/UA and unknown countries still go to RDAP
+        cc = df["countrycode"] if "countrycode" in df.columns else _mmdb_country(src)
+        unknown = cc.astype("string").str.strip().fillna("").eq("").to_numpy()
+        src = src[(_ruua_codes(cc) > 0) | unknown]
+    return df, _unique_ips(src)
+
+@functools.lru_cache(maxsize=None)
+def _country_reader():
+    try:
+        import maxminddb
+        return maxminddb.open_database(GEOIP_COUNTRY)
+    except Exception as e:
+        log(f"[geoip] country MMDB not available ({e}); no MaxMind pre-filter")
+        return None
 
+def _mmdb_country(src: pd.Series) -> pd.Series:
+    # MaxMind country per row, looked up once per distinct IP
+    rd = _country_reader() if GEOIP_COUNTRY else None
+    if rd is None:
+        return pd.Series(pd.NA, index=src.index, dtype="string")
+    def _cc(ip):
+        try:
+            r = rd.get(str(ip)) or {}
+        except ValueError:
+            return None
+        return (r.get("country") or r.get("registered_country") or {}).get("iso_code")
+    codes, uniq = pd.factorize(src)
+    cc = np.array([_cc(u) for u in uniq] + [None], dtype=object)
+    return pd.Series(cc[codes], index=src.index, dtype="string")
+
+def _unique_ips(s: pd.Series) -> list:
+    # distinct non-null values as str, hashed by Arrow instead of a Python set of per-row strings
+    arr = pa.array(s, from_pandas=True)
+    if pa.types.is_dictionary(arr.type):
+        arr = arr.dictionary_decode()
+    if not pa.types.is_string(arr.type):
+        arr = pc.cast(arr, pa.string())
+    return pc.unique(pc.drop_null(arr)).to_pylist()
+
+_queried = set()   # IPs already sent to RDAP by this process: cache retries apply to earlier runs only
+_inflight = {}     # ip -> Future, resolved once the lookup's result is in the cache (files merged concurrently)
+_inflight_lock = threading.Lock()
+# one lookup pool shared by every resolve() call, so files merged concurrently (MERGE_WORKERS) still keep
+# at most RDAP_WORKERS lookups, and keep-alive connections per host, in flight
+_lookup_pool = ThreadPoolExecutor(max_workers=RDAP_WORKERS, thread_name_prefix="rdap")
+
+def select_queries(ips: list, cache: dict) -> list:
     # decide which IPs need fresh queries
     to_query, used = [], 0
     for ip in ips:
+        if ip in _queried:
+            continue
         c = cache.get(ip)
         if not c:
             pass  
@@ -363,107 +872,272 @@ def process_csv(path: Path, cache: dict) -> pd.DataFrame:
                 pass      
             elif ok:
                 continue  
+        if RDAP_CIDR_CACHE:
+            # answered by a cached network covering this IP (kept in memory only, not re-written)
+            hit = _cidr_lookup(ip)
+            if hit and (hit.get("rdap_net_cc") or not RDAP_RETRY_EMPTY_CC):
+                cache[ip] = hit
+                continue
         if RDAP_BUDGET and used >= RDAP_BUDGET:
             break
         to_query.append(ip); used += 1
+    return to_query
 
+def resolve(to_query: list, cache: dict, desc: str):
     # parallel RDAP lookups
-    if to_query:
-        desc = f"RDAP {path.name}"
-        disable = _tqdm_disable_default()
+    with _inflight_lock:
+        # IPs claimed by another file since select_queries are waited for in wait_inflight() instead
+        to_query = [ip for ip in to_query if ip not in _queried]
+        _queried.update(to_query)
+        done = {ip: Future() for ip in to_query}
+        _inflight.update(done)
+    if not to_query:
+        return
+    disable = _tqdm_disable_default()
+    futs = {}
+    try:
         with tqdm(total=len(to_query), desc=desc, unit="ip", mininterval=TQDM_MININTERVAL, disable=disable) as rdap_pbar:
-            with ThreadPoolExecutor(max_workers=RDAP_WORKERS) as ex:
-                futs = {ex.submit(rdap_lookup, ip): ip for ip in to_query}
-                for f in as_completed(futs):
-                    ip = futs[f]
-                    data = f.result()
-                    cache[ip] = data
-                    _cache_q.put((ip, data))
-                    rdap_pbar.update(1)
-
-    # build RDAP frame and merge 
-    rows = []
-    for ip in ips:
-        r = cache.get(ip) or {}
-        rows.append({
-            "src": ip,
-            "rdap_ok": bool(r.get("ok")) if r else None,
-            "rdap_net_cc": (r.get("rdap_net_cc") or None) if r else None,
-            "rdap_org": r.get("rdap_org") if r else None,
-            "rdap_cidr": r.get("rdap_cidr") if r else None,
-            "rir": r.get("rir") if r else None,
-            "rdap_error": r.get("error") if r else None,
-        })
-    rd = pd.DataFrame(rows)
-
-    out = df.merge(rd, on="src", how="left")
-    # consensus columns
-    cons, rule = consensus_cols(out, bool(STRICT_ONLY))
-    out["country_consensus"] = cons
-    out["consensus_rule"] = rule
-    return out
+            futs = {_lookup_pool.submit(rdap_lookup, ip): ip for ip in to_query}
+            for f in as_completed(futs):
+                ip = futs[f]
+                data = f.result()
+                cache[ip] = data
+                cache_put(ip, data)
+                if RDAP_CIDR_CACHE and data.get("ok"):
+                    _cidr_add(data)
+                done[ip].set_result(None)
+                rdap_pbar.update(1)
+    finally:
+        for f in futs:
+            f.cancel()   # interrupted: drop this file's lookups that have not started
+        with _inflight_lock:
+            for ip, d in done.items():
+                _inflight.pop(ip, None)
+                if not d.done():
+                    d.set_exception(RuntimeError(f"RDAP lookup of {ip} aborted"))
+
+def wait_inflight(ips: list):
+    # block until lookups of these IPs submitted by other files have reached the cache
+    if not _inflight:
+        return
+    with _inflight_lock:
+        pending = [_inflight[ip] for ip in ips if ip in _inflight]
+    for d in pending:
+        d.result()   # re-raises if that lookup failed, so the file is reported instead of merged without RDAP
+
+def ip_shard(ip: str) -> int:
+    # stable across processes (unlike hash())
+    return zlib.crc32(ip.encode()) % max(1, SHARD_TOTAL)
+
+def candidate_ips(paths: list) -> set:
+    # candidate IPs of the given partitions, deduplicated (only the columns the filters need are read)
+    ips = set()
+    for p in paths:
+        ips.update(_prepare(p, CANDIDATE_COLS)[1])
+    return ips
+
+def lookup_shard(paths: list, cache: dict, ips: set = None):
+    # lookup phase: candidate IPs of all partitions, deduplicated, restricted to this shard's IP bucket
+    if ips is None:
+        ips = candidate_ips(paths)
+    mine = sorted(ip for ip in ips if ip_shard(ip) == SHARD_IDX)
+    to_query = select_queries(mine, cache)
+    log(f"[lookup] unique_ips={len(ips):,} | shard={SHARD_IDX}/{SHARD_TOTAL} → {len(mine):,} ({len(to_query):,} to query)")
+    resolve(to_query, cache, f"RDAP shard {SHARD_IDX}/{SHARD_TOTAL}")
+
+SHARD_POLL_S = 5.0   # how often await_shards() checks the cache file
+
+def await_shards(ips, cache: dict):
+    # phase all, sharded: IPs of the other shards' buckets are resolved by those shards. Wait until the cache
+    # holds an entry for each, or until RDAP_SHARD_WAIT seconds pass without the cache file growing (a shard
+    # that stopped or ran out of RDAP_BUDGET); the merge queries only what is still missing then
+    def _missing(ips):
+        return {ip for ip in ips if ip_shard(ip) != SHARD_IDX and ip not in cache
+                and not (RDAP_CIDR_CACHE and _cidr_lookup(ip))}
+    missing = _missing(ips)
+    if not missing:
+        return
+    n, size, since = len(missing), None, time.monotonic()
+    log(f"[shards] waiting for {n:,} IPs of other shards' buckets")
+    while missing:
+        cur = RDAP_CACHE.stat().st_size if RDAP_CACHE.exists() else 0
+        if cur != size:
+            size, since = cur, time.monotonic()
+            cache.update(load_cache(RDAP_CACHE, missing))
+            missing = _missing(missing)
+        elif time.monotonic() - since >= RDAP_SHARD_WAIT:
+            break
+        else:
+            time.sleep(min(SHARD_POLL_S, RDAP_SHARD_WAIT))
+    log(f"[shards] {n - len(missing):,} of {n:,} IPs cached by other shards"
+        + (f", {len(missing):,} left to query here" if missing else ""))
+
+def _rdap_frame(ips: list, cache: dict) -> pd.DataFrame:
+    # RDAP columns per IP (one preallocated column per field, no per-row dicts), indexed by src
+    n = len(ips)
+    ok, cc, org, cidr, rir, err = (np.full(n, None, dtype=object) for _ in range(6))
+    for i, ip in enumerate(ips):
+        r = cache.get(ip)
+        if r:
+            ok[i] = bool(r.get("ok"))
+            cc[i] = r.get("rdap_net_cc") or None
+            org[i] = r.get("rdap_org")
+            cidr[i] = r.get("rdap_cidr")
+            rir[i] = r.get("rir")
+            err[i] = r.get("error")
+    return pd.DataFrame({"rdap_ok": ok, "rdap_net_cc": cc, "rdap_org": org, "rdap_cidr": cidr,
+                         "rir": rir, "rdap_error": err}, index=pd.Index(ips, name="src"), copy=False).infer_objects()
+
+def process_csv(path: Path, cache: dict, batch_rows: int = MERGE_BATCH_ROWS, ips: list = None):
+    # per-file pipeline, yields the output in batches of ~batch_rows rows (0: one frame):
+    # 1) candidate IPs (only the columns needed; `ips` if main() has them already) 2) parallel RDAP
+    # 3) stream the partition: CDN exclusion, merge + consensus per batch
+    if batch_rows > 0:
+        df = None
+        if ips is None:
+            ips = _prepare(path, CANDIDATE_COLS)[1]
+    else:
+        df, ips = _prepare(path)
+    to_query = select_queries(ips, cache)   # also fills CIDR-cache hits
+    if RDAP_PHASE == "all" and SHARD_TOTAL > 1:
+        # other buckets were resolved by their shards (await_shards): only what they never cached is queried here
+        to_query = [ip for ip in to_query if ip_shard(ip) == SHARD_IDX or ip not in cache]
+    if RDAP_PHASE != "merge":
+        # merge phase: no network, the lookup phase of every shard has filled the cache
+        resolve(to_query, cache, f"RDAP {path.name}")
+        wait_inflight(ips)
+
+    # `ips` is already the unique key set: index rd by src so the join probes it directly
+    # instead of hashing both sides again as merge(on="src") does
+    rd = _rdap_frame(ips, cache)
+    frames = [df] if df is not None else (
+        _to_frame(exclude_cdn(t) if CDN_EXCLUDE else t) for t in iter_tables(path, batch_rows))
+    for df in frames:
+        out = df.join(rd, on="src", how="left").reset_index(drop=True)
+        # consensus columns
+        cons, rule = consensus_cols(out, bool(STRICT_ONLY))
+        out["country_consensus"] = cons
+        out["consensus_rule"] = rule
+        yield out
+
+def _side_table(frames):
+    # OUT_COLUMNS=added: one row per src (first occurrence) across all batches
+    seen = set()
+    for out in frames:
+        out = out[["src", *RDAP_COLS]].drop_duplicates("src")
+        out = out[~out["src"].isin(seen)]
+        seen.update(out["src"])
+        yield out
 
 def main():
     if not PART_DIR.exists():
         log(f"[FATAL] PART_DIR not found: {PART_DIR}")
         sys.exit(1)
         
-    # load cache into memory
-    cache = load_cache(RDAP_CACHE)
-    
-    # find input CSVs: prefer PART_DIR/YYYY/*.csv, else PART_DIR/*.csv
+    # find input partitions (Parquet or CSV): prefer PART_DIR/YYYY/*, else PART_DIR/*
+    def _parts(d: Path):
+        return sorted(p for p in d.glob("*") if p.suffix in (".parquet", ".csv"))
     all_csvs = []
     for year_dir in sorted(PART_DIR.glob("*")):
         if year_dir.is_dir():
-            all_csvs.extend(sorted(year_dir.glob("*.csv")))
+            all_csvs.extend(_parts(year_dir))
     if not all_csvs:
-        all_csvs = sorted(PART_DIR.glob("*.csv"))
+        all_csvs = _parts(PART_DIR)
     if not all_csvs:
-        log(f"[FATAL] no input CSVs under: {PART_DIR}")
+        log(f"[FATAL] no input partitions under: {PART_DIR}")
         sys.exit(1)
 
-    # shared assignment
+    def _out_path(p: Path) -> Path:
+        return (OUT_DIR / p.relative_to(PART_DIR)).with_suffix(f".{OUT_FORMAT}")
+    pending = [p for p in all_csvs if not (SKIP_IF_EXISTS and _out_path(p).exists())]
+
+    # shared assignment: IPs by hash bucket for lookups, files round-robin for the merge
     my_jobs = [p for i, p in enumerate(all_csvs) if (i % max(1, SHARD_TOTAL)) == SHARD_IDX]
     N = len(my_jobs)
-    log(f"[RDAP] total_files={len(all_csvs)} | shard={SHARD_IDX}/{SHARD_TOTAL} → assigned={N}")
+    log(f"[RDAP] total_files={len(all_csvs)} | shard={SHARD_IDX}/{SHARD_TOTAL} → assigned={N} | phase={RDAP_PHASE}")
+
+    # candidate IPs, read once per file: of every pending file for the lookup, of this shard's own
+    # pending files for the merge (kept per file and handed to process_csv)
+    my_pending = set(pending).intersection(my_jobs) if RDAP_PHASE != "lookup" else set()
+    all_ips, file_ips = set(), {}
+    for p in (pending if RDAP_PHASE in ("all", "lookup") else [p for p in pending if p in my_pending]):
+        ips = _prepare(p, CANDIDATE_COLS)[1]
+        all_ips.update(ips)
+        if p in my_pending:
+            file_ips[p] = ips
+
+    # load into memory only the cache entries this process can use: its IP bucket (lookup) and the
+    # IPs of its own pending files (merge), so sharded processes do not each hold the whole cache
+    keep = {ip for ip in all_ips if ip_shard(ip) == SHARD_IDX}.union(*file_ips.values())
+    cache = load_cache(RDAP_CACHE, keep)
+    if RDAP_CIDR_CACHE:
+        for d in cache.values():
+            if d.get("ok"):
+                _cidr_add(d)
+    log(f"[cache] {len(cache)} IPs kept, {sum(map(len, _cidr_index.values()))} networks indexed")
+    _rdap_bootstrap[:] = load_bootstrap(RDAP_BOOTSTRAP)
+    index_bootstrap(_rdap_bootstrap)
+    log(f"[bootstrap] {len(_rdap_bootstrap)} RDAP ranges from {RDAP_BOOTSTRAP}")
 
     # start background cache writer
     stop_evt = threading.Event()
     writer_t = threading.Thread(target=cache_writer_thread, args=(RDAP_CACHE, stop_evt), daemon=True)
     writer_t.start()
     
-    # process files
     disable = _tqdm_disable_default()
     try:
-        with tqdm(total=N, desc=f"Files shard {SHARD_IDX}/{SHARD_TOTAL}", unit="file",
-                  mininterval=TQDM_MININTERVAL, disable=disable) as files_pbar:
-            for csv in my_jobs:
-                rel = csv.relative_to(PART_DIR)
-                out_path = OUT_DIR / rel
-                out_path.parent.mkdir(parents=True, exist_ok=True)
+        if RDAP_PHASE in ("all", "lookup"):
+            lookup_shard(pending, cache, all_ips)
+        if RDAP_PHASE == "lookup":
+            return
+        if RDAP_PHASE == "all" and SHARD_TOTAL > 1:
+            # pick up what the other shards have resolved so far, and wait for the rest of their buckets
+            cache.update(load_cache(RDAP_CACHE, keep))
+            await_shards(set().union(*file_ips.values()), cache)
 
-                if SKIP_IF_EXISTS and out_path.exists():
-                    files_pbar.update(1)
-                    log(f"[skip] {rel} (exists)")
-                    append_progress({"file": str(rel), "status":"skip_exists"})
-                    continue
+        def _merge_one(csv: Path):
+            rel = csv.relative_to(PART_DIR)
+            out_path = _out_path(csv)
+            out_path.parent.mkdir(parents=True, exist_ok=True)
 
+            if SKIP_IF_EXISTS and out_path.exists():
+                log(f"[skip] {rel} (exists)")
+                append_progress({"file": str(rel), "status":"skip_exists"})
+                return
+
+            try:
+                log(f"[proc] {rel} → {out_path}")
+                def _frames(batch_rows=MERGE_BATCH_ROWS):
+                    frames = process_csv(csv, cache, batch_rows, file_ips.get(csv))
+                    # side table, one row per src; join back onto the input partition on `src`
+                    return _side_table(frames) if OUT_COLUMNS == "added" else frames
                 try:
-                    log(f"[proc] {rel} → {out_path}")
-                    out = process_csv(csv, cache)
-                    write_atomic(out_path, out)
-                    append_progress({"file": str(rel), "status":"ok", "rows": int(len(out))})
-                except Exception as e:
-                    append_error(f"{rel}: {e}")
-                    append_progress({"file": str(rel), "status":"error", "error": str(e)})
-                    log(f"[error] {rel}: {e}")
-                finally:
+                    rows = write_atomic(out_path, _frames())
+                except pa.ArrowInvalid as e:
+                    if MERGE_BATCH_ROWS <= 0:
+                        raise
+                    # a later batch did not fit the first batch's types (e.g. CSV type inference): whole file
+                    log(f"[merge] {rel}: batches not uniform ({e}); retrying as one batch")
+                    rows = write_atomic(out_path, _frames(0))
+                append_progress({"file": str(rel), "status":"ok", "rows": rows})
+            except Exception as e:
+                append_error(f"{rel}: {e}")
+                append_progress({"file": str(rel), "status":"error", "error": str(e)})
+                log(f"[error] {rel}: {e}")
+
+        # process files (merge): up to MERGE_WORKERS files in flight, so one file's read/merge/write
+        # overlaps the next (Arrow I/O and most pandas merge work release the GIL)
+        with tqdm(total=N, desc=f"Files shard {SHARD_IDX}/{SHARD_TOTAL}", unit="file",
+                  mininterval=TQDM_MININTERVAL, disable=disable) as files_pbar:
+            with ThreadPoolExecutor(max_workers=max(1, MERGE_WORKERS)) as ex:
+                for f in as_completed([ex.submit(_merge_one, csv) for csv in my_jobs]):
+                    f.result()
                     files_pbar.update(1)
     finally:
         stop_evt.set()
         writer_t.join()
 
-    log("[DONE] all assigned files processed.")
+    log("[DONE] all assigned files processed." if RDAP_PHASE != "lookup" else "[DONE] lookup phase finished.")
 
 if __name__ == "__main__":
     try:
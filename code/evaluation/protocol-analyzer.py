@@ -23,19 +23,31 @@ Also keeps:
   * overall_ukraine_monthly_share_count.pdf / overall_ukraine_monthly_share_pps.pdf
 """
 
+import os
+import hashlib
 from pathlib import Path
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import matplotlib as mpl
+mpl.use("Agg")   # batch run: figures are only saved, never shown
 import matplotlib.pyplot as plt
-from matplotlib.dates import MonthLocator, DateFormatter
-import matplotlib as mpl  
+from matplotlib.dates import MonthLocator, DateFormatter, date2num
 
 try:
     from tqdm.auto import tqdm
 except Exception:
     def tqdm(x, *a, **k): return x
 
+try:
+    from numba import njit, prange   # optional: compiled week-expansion kernel
+except ImportError:
+    njit = None
+
 # Config
 BASE_DIR = Path("all_v2")
 
@@ -59,15 +71,14 @@ HONTYPE_COL = "honeypot_type"
 TARGET_COUNTRIES = ["RU", "UA"]
 
 CHUNKSIZE = 200_000
+WORKERS = os.cpu_count() or 1   # processes reading/aggregating files in parallel (1 = sequential)
 USECOLS_BASE = [START_COL, END_COL, COUNTRY_COL, CONS_COL, DPORT_COL, HONTYPE_COL, PKT_COL]
-DTYPE_MAP = {
-    START_COL: str, END_COL: str, COUNTRY_COL: str, CONS_COL: str,
-    DPORT_COL: str, HONTYPE_COL: str, PKT_COL: str
-}
 
 OUTDIR = Path("out_protocol")
 OUTDIR.mkdir(parents=True, exist_ok=True)
 
+CACHE_DIR = Path("cache_parquet")   # per-file aggregates, reused while the input and aggregation config are unchanged (None = off)
+
 # Matplotlib style
 plt.rcParams.update({
     "font.size": 11,
@@ -113,6 +124,7 @@ DISPLAY_ORDER = [
     "DNS", "NTP", "WS-Discovery", "SSDP", "CLDAP",
     "SNMP", "Chargen", "ARD", "CoAP", "Others"
 ]
+PROTO_DTYPE = pd.CategoricalDtype(DISPLAY_ORDER, ordered=True)   # protocol columns/keys keep this order intrinsically
 
 # Fixed protocol colors
 # \definecolor{clrDNS}{rgb}{0.1216,0.4667,0.7059}
@@ -136,7 +148,7 @@ def map_port_to_proto(dport_val) -> str:
         port = int(str(dport_val).strip())
     except Exception:
         return "Unknown"
-    return PORT_TO_PROTO.get(port, f"port{port}")
+    return PORT_TO_PROTO.get(port, "Others")   # unmapped ports collapse to Others anyway
 
 # protocol labelling (classified to Others)
 def canonical_protocol(label: str) -> str:
@@ -144,71 +156,196 @@ def canonical_protocol(label: str) -> str:
         return label
     return "Others"
 
-# time helpers (UTC)
-def to_utc(x) -> pd.Timestamp:
-    t = pd.Timestamp(x)
-    if t.tz is None:
-        return t.tz_localize("UTC")
-    return t.tz_convert("UTC")
-
-def week_bounds_monday(dt: pd.Timestamp):
-    dt = to_utc(dt)
-    start = (dt.normalize() - pd.Timedelta(days=int(dt.weekday())))
-    end = start + pd.Timedelta(days=7)
-    return start, end
-
-def iter_week_starts(a_start: pd.Timestamp, a_end: pd.Timestamp):
-    ws, _ = week_bounds_monday(a_start)
-    we, _ = week_bounds_monday(a_end)
-    cur = ws
-    while cur <= we:
-        yield cur
-        cur += pd.Timedelta(days=7)
-
-# enumerate all files for the input
+# dport -> canonical protocol code (into DISPLAY_ORDER) for every port, applied to whole columns:
+# same labels as canonical_protocol(map_port_to_proto(p)); non-integer or out-of-range ports are "Others"
+MAX_PORT = 65535
+PROTO_LUT = np.full(MAX_PORT + 1, DISPLAY_ORDER.index("Others"), dtype=np.int8)
+for _port, _name in PORT_TO_PROTO.items():
+    PROTO_LUT[_port] = DISPLAY_ORDER.index(canonical_protocol(_name))
+
+def proto_codes(dport: pd.Series) -> pd.Categorical:
+    port = pd.to_numeric(dport, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    valid = (port >= 0) & (port <= MAX_PORT) & (port % 1 == 0)
+    codes = np.full(len(port), DISPLAY_ORDER.index("Others"), dtype=np.int8)
+    codes[valid] = PROTO_LUT[port[valid].astype(np.int64)]
+    return pd.Categorical.from_codes(codes, dtype=PROTO_DTYPE)
+
+# string normalization applied once per distinct value (missing values normalize like the string "nan")
+def norm_labels(col: pd.Series, fn) -> np.ndarray:
+    codes, uniq = pd.factorize(col)
+    labels = np.array([fn(str(u)) for u in uniq] + [fn("nan")], dtype=object)
+    return labels[codes]
+
+# week slices as int64 ns: week k starts at EPOCH_MONDAY_NS + k*WEEK_NS (1970-01-05 is a Monday)
+WEEK_NS = 7 * 86400 * 10**9
+EPOCH_MONDAY_NS = 4 * 86400 * 10**9
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _expand_weeks_kernel(s64, e64, w0, n_w, starts, out_row, out_week, out_ovl):
+        # one pass per row, writing its week slices at starts[i] .. starts[i] + n_w[i]
+        for i in prange(len(s64)):
+            for j in range(n_w[i]):
+                k = starts[i] + j
+                w = w0[i] + j
+                ws = w * WEEK_NS + EPOCH_MONDAY_NS
+                out_row[k] = i
+                out_week[k] = w
+                out_ovl[k] = min(e64[i], ws + WEEK_NS) - max(s64[i], ws)
+
+def expand_weeks(s64: np.ndarray, e64: np.ndarray):
+    """
+    Split each interval [s64[i], e64[i]) (int64 ns, UTC) into its Monday-based weeks.
+    Returns (row, week, overlap_sec) for every week slice with a positive overlap.
+    """
+    w0 = (s64 - EPOCH_MONDAY_NS) // WEEK_NS
+    n_w = (e64 - EPOCH_MONDAY_NS) // WEEK_NS - w0 + 1
+    if njit is not None:
+        starts = np.cumsum(n_w) - n_w
+        total = int(n_w.sum())
+        row = np.empty(total, dtype=np.int64)
+        week = np.empty(total, dtype=np.int64)
+        overlap = np.empty(total, dtype=np.int64)
+        _expand_weeks_kernel(s64, e64, w0, n_w, starts, row, week, overlap)
+    else:
+        row = np.repeat(np.arange(len(s64)), n_w)
+        week = w0[row] + (np.arange(len(row)) - np.repeat(np.cumsum(n_w) - n_w, n_w))
+        ws = week * WEEK_NS + EPOCH_MONDAY_NS
+        overlap = np.minimum(e64[row], ws + WEEK_NS) - np.maximum(s64[row], ws)
+    keep = overlap > 0
+    return row[keep], week[keep], overlap[keep] / 1e9
+
+# enumerate all files for the input (YYYY-MM.parquet, else YYYY-MM.csv)
 def enumerate_all_files():
     files = []
     for y in YEARS:
         for m in MONTHS_BY_YEAR[y]:
-            f = BASE_DIR / f"{y}" / f"{y}-{m:02d}.csv"
-            if f.exists():
-                files.append(f)
+            for ext in (".parquet", ".csv"):
+                f = BASE_DIR / f"{y}" / f"{y}-{m:02d}{ext}"
+                if f.exists():
+                    files.append(f)
+                    break
     return files
 
+def file_columns(f):
+    if f.suffix == ".parquet":
+        return pq.read_schema(f).names
+    return list(pd.read_csv(f, nrows=0).columns)
+
 # check the necessary columns
 def ensure_columns(first_file):
-    head = pd.read_csv(first_file, nrows=1)
+    cols = file_columns(first_file)
     need = [DPORT_COL, CONS_COL, COUNTRY_COL, START_COL, END_COL, PKT_COL]
-    missing = [c for c in need if c not in head.columns]
+    missing = [c for c in need if c not in cols]
     if missing:
-        raise RuntimeError(f"Missing columns {missing}. Columns: {list(head.columns)}")
+        raise RuntimeError(f"Missing columns {missing}. Columns: {cols}")
     return True
 
+# string timestamps -> timestamp[ns, UTC] in Arrow (naive values are UTC); pandas handles anything else
+def arrow_utc(col):
+    for t in (pa.timestamp("ns"), pa.timestamp("ns", "UTC")):
+        try:
+            col = pc.cast(col, t)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            continue
+        return pc.assume_timezone(col, "UTC") if t.tz is None else col
+    return pa.array(pd.to_datetime(col.to_pandas(), errors="coerce", utc=True))
+
+# RU/UA + strict filter evaluated in Arrow (same normalization as norm_labels: case-folded string value)
+def strict_target_rows(tbl):
+    def label(name, fold):
+        col = tbl[name]
+        if not (pa.types.is_string(col.type) or pa.types.is_large_string(col.type)):
+            col = pc.cast(col, pa.string())
+        return fold(col)
+    keep = pc.and_(pc.equal(label(CONS_COL, pc.utf8_lower), "strict"),
+                   pc.is_in(label(COUNTRY_COL, pc.utf8_upper), value_set=pa.array(TARGET_COUNTRIES)))
+    return tbl.filter(pc.fill_null(keep, False))
+
+# read one monthly file in CHUNKSIZE-row chunks; only strict RU/UA rows reach pandas
+def iter_chunks(fpath):
+    if fpath.suffix == ".parquet":
+        pf = pq.ParquetFile(fpath)
+        cols = [c for c in USECOLS_BASE if c in pf.schema_arrow.names]
+        for batch in pf.iter_batches(batch_size=CHUNKSIZE, columns=cols):
+            batch = strict_target_rows(batch)
+            if batch.num_rows:
+                yield batch.to_pandas()
+        return
+    # CSV: Arrow parses only the needed columns, multi-threaded, one block at a time (~64 bytes per row
+    # at most, so a block holds at most about CHUNKSIZE rows and a worker never holds a whole partition);
+    # timestamps are converted in Arrow
+    cols = [c for c in USECOLS_BASE if c in file_columns(fpath)]
+    reader = pacsv.open_csv(
+        fpath,
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=max(1 << 20, CHUNKSIZE * 64)),
+        parse_options=pacsv.ParseOptions(invalid_row_handler=lambda row: "skip"),
+        convert_options=pacsv.ConvertOptions(include_columns=cols, column_types={c: pa.string() for c in cols},
+                                             strings_can_be_null=True),
+    )
+    for block in reader:
+        tbl = strict_target_rows(pa.Table.from_batches([block]))
+        if not tbl.num_rows:
+            continue
+        for c in (START_COL, END_COL):
+            if c in tbl.column_names:
+                tbl = tbl.set_column(tbl.schema.get_field_index(c), c, arrow_utc(tbl[c]))
+        for batch in tbl.to_batches(max_chunksize=CHUNKSIZE):
+            yield batch.to_pandas()
+
 # plot helpers 
-def stacked_area_monthly(df_month_proto, title, pdf_path, color_map_global):
+_FIGURES = {}
+MONTH_FORMATTER = DateFormatter("%Y-%m")   # stateless: shared by every date axis
+
+def reuse_figure(key, clear=True, **subplots_kw):
+    """Create the figure for `key` once; later calls return it (axes cleared if `clear`). Third value: newly created."""
+    if key in _FIGURES:
+        fig, axes = _FIGURES[key]
+        if clear:
+            for ax in np.ravel(axes):
+                ax.cla()
+        return fig, axes, False
+    fig, axes = plt.subplots(**subplots_kw)
+    _FIGURES[key] = (fig, axes)
+    return fig, axes, True
+
+def close_figures():
+    """Close every figure kept by reuse_figure()."""
+    for fig, _ in _FIGURES.values():
+        plt.close(fig)
+    _FIGURES.clear()
+
+def stacked_area_monthly(df_month_proto, title, pdf_paths, color_map_global, xlim=None):
     if df_month_proto.empty:
         return
     pct = df_month_proto.div(df_month_proto.sum(axis=1).replace(0, np.nan), axis=0) * 100.0
     pct = pct.fillna(0.0)
-    fig, ax = plt.subplots(figsize=(12, 6))
-    cols = [c for c in DISPLAY_ORDER if c in df_month_proto.columns]
-    x = pct.index
+    cols = list(pct.columns)   # collapse_to_important() output: DISPLAY_ORDER
+    x = date2num(pct.index)  # plain float days: skips per-point datetime unit conversion
     y = [pct[col].values for col in cols]
     colors = [color_map_global[col] for col in cols]
+    xlim = xlim or (x.min(), x.max())
+    # one figure per x-range; its axes, ticks and layout are set up once, later scopes only swap the areas
+    fig, ax, fresh = reuse_figure(("stacked_area", xlim), clear=False, figsize=(12, 6))
+    if fresh:
+        ax.set_ylabel("Percent (%)")
+        ax.set_xlabel("Date")
+        ax.set_ylim(0, 100)
+        ax.xaxis_date()
+        ax.set_xlim(*xlim)
+        ax.margins(x=0)
+        ax.xaxis.set_major_locator(MonthLocator(interval=4))
+        ax.xaxis.set_major_formatter(MONTH_FORMATTER)
+        for lbl in ax.get_xticklabels():
+            lbl.set_rotation(45); lbl.set_ha("right")
+        fig.tight_layout()
+    else:
+        for coll in list(ax.collections):
+            coll.remove()
     ax.stackplot(x, *y, labels=cols, colors=colors, linewidth=0.5, edgecolor="white")
     ax.set_title(title)
-    ax.set_ylabel("Percent (%)")
-    ax.set_xlabel("Date")
-    ax.set_ylim(0, 100)
-    ax.set_xlim(x.min(), x.max())
-    ax.margins(x=0)
-    ax.xaxis.set_major_locator(MonthLocator(interval=4))
-    ax.xaxis.set_major_formatter(DateFormatter("%Y-%m"))
-    for lbl in ax.get_xticklabels():
-        lbl.set_rotation(45); lbl.set_ha("right")
-    fig.tight_layout()
-    fig.savefig(pdf_path, dpi=150, bbox_inches="tight")
-    plt.close(fig)
+    for pdf_path in pdf_paths:
+        fig.savefig(pdf_path, dpi=150)
 
 # global color map 
 def build_global_color_map(all_labels):
@@ -224,37 +361,37 @@ def build_global_color_map(all_labels):
 def collapse_to_important(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return df
-    keep = [c for c in df.columns if c in IMPORTANT_PROTOCOLS]
-    others_cols = [c for c in df.columns if c not in keep]
+    others_cols = [c for c in df.columns if c not in IMPORTANT_PROTOCOLS]
     out = pd.DataFrame(index=df.index)
-    for c in IMPORTANT_PROTOCOLS:
-        out[c] = df[c] if c in df.columns else 0
-    out["Others"] = df[others_cols].sum(axis=1) if others_cols else 0
-    out = out[[c for c in DISPLAY_ORDER if c in out.columns]]
+    for c in DISPLAY_ORDER:
+        if c == "Others":
+            out[c] = df[others_cols].sum(axis=1) if others_cols else 0
+        else:
+            out[c] = df[c] if c in df.columns else 0
     return out
 
-# bucket for {counts/packets/dur}[proto][week]
-def mk_scope_bucket():
-    return {
-        "counts": defaultdict(lambda: defaultdict(int)),
-        "packets": defaultdict(lambda: defaultdict(float)),
-        "dur": defaultdict(lambda: defaultdict(float)),
-    }
-
-# each scope bucket is transformed into a 'week * protocol' data frame
-def dict_to_week_df(proto_map, dtype=float):
-    if not proto_map:
-        return pd.DataFrame()
-    weeks_sets = [set(d.keys()) for d in proto_map.values()]
-    if not weeks_sets:
-        return pd.DataFrame()
-    weeks = sorted(set().union(*weeks_sets))
-    protos = sorted(proto_map.keys())
-    df = pd.DataFrame(0, index=weeks, columns=protos, dtype=dtype)
-    for proto_lbl, wdict in proto_map.items():
-        for wk, val in wdict.items():
-            df.at[wk, proto_lbl] = df.at[wk, proto_lbl] + dtype(val)
-    return df
+# long-form aggregate: one row per (cc, ht, proto, week) with summed cnt / pkt / dur
+AGG_KEYS = ["cc", "ht", "proto", "week"]
+AGG_VALS = ["cnt", "pkt", "dur"]
+
+# scope bucket {counts/packets/dur}: 'week * protocol' data frames of the matching rows
+def scope_frames(agg: pd.DataFrame, cc=None, ht=None) -> dict:
+    m = np.ones(len(agg), dtype=bool)
+    if cc is not None:
+        m &= (agg["cc"] == cc).to_numpy()
+    if ht is not None:
+        m &= (agg["ht"] == ht).to_numpy()
+    sub = agg[m]
+    if sub.empty:
+        return {"counts": pd.DataFrame(), "packets": pd.DataFrame(), "dur": pd.DataFrame()}
+    wide = sub.groupby(["week", "proto"], observed=True)[AGG_VALS].sum().unstack("proto", fill_value=0).astype(float)
+    weeks = pd.to_datetime(wide.index.to_numpy() * WEEK_NS + EPOCH_MONDAY_NS, utc=True)
+    out = {}
+    for key, col in (("counts", "cnt"), ("packets", "pkt"), ("dur", "dur")):
+        df = wide[col].set_axis(weeks, axis=0)
+        df.columns = pd.Index(df.columns.astype(str))
+        out[key] = df
+    return out
 
 # process: count + pps
 def process_scope_dual(df_week_cnt: pd.DataFrame,
@@ -262,7 +399,8 @@ def process_scope_dual(df_week_cnt: pd.DataFrame,
                        df_week_dur: pd.DataFrame,
                        scope_name: str,
                        outdir: Path,
-                       color_map_global):
+                       color_map_global,
+                       xlim=None):
     """Return (overall_count_series, overall_pps_series) with DISPLAY_ORDER index."""
     if (df_week_cnt is None or df_week_cnt.empty) and \
        (df_week_pkt is None or df_week_pkt.empty) and \
@@ -283,23 +421,16 @@ def process_scope_dual(df_week_cnt: pd.DataFrame,
     else:
         m_pps = pd.DataFrame()
 
-    # monthly stacks (visuals)
+    # monthly stacks (visuals); overall RU/UA alias files are saved from the same drawing
+    tag = {"RU": "overall_russia", "UA": "overall_ukraine"}.get(scope_name)
     if not m_cnt.empty:
         stacked_area_monthly(
             m_cnt,
             title=f"",
-            pdf_path=str(outdir / f"monthly_share_protocol_{scope_name}_count.pdf"),
-            color_map_global=color_map_global
+            pdf_paths=[str(outdir / f"monthly_share_protocol_{scope_name}_count.pdf")]
+                      + ([str(outdir / f"{tag}_monthly_share_count.pdf")] if tag else []),
+            color_map_global=color_map_global, xlim=xlim
         )
-        # overall RU/UA alias files (Count)
-        if scope_name in ("RU", "UA"):
-            tag = "overall_russia" if scope_name == "RU" else "overall_ukraine"
-            stacked_area_monthly(
-                m_cnt,
-                title=f"",
-                pdf_path=str(outdir / f"{tag}_monthly_share_count.pdf"),
-                color_map_global=color_map_global
-            )
 
         monthly_totals = pd.DataFrame({"total_attacks": m_cnt_raw.sum(axis=1).astype(int)})
         weekly_totals  = pd.DataFrame({"total_attacks": df_week_cnt.sum(axis=1).astype(int)})
@@ -310,18 +441,10 @@ def process_scope_dual(df_week_cnt: pd.DataFrame,
         stacked_area_monthly(
             m_pps,
             title=f"",
-            pdf_path=str(outdir / f"monthly_share_protocol_{scope_name}_pps.pdf"),
-            color_map_global=color_map_global
+            pdf_paths=[str(outdir / f"monthly_share_protocol_{scope_name}_pps.pdf")]
+                      + ([str(outdir / f"{tag}_monthly_share_pps.pdf")] if tag else []),
+            color_map_global=color_map_global, xlim=xlim
         )
-        # overall RU/UA alias files (pps)
-        if scope_name in ("RU", "UA"):
-            tag = "overall_russia" if scope_name == "RU" else "overall_ukraine"
-            stacked_area_monthly(
-                m_pps,
-                title=f"",
-                pdf_path=str(outdir / f"{tag}_monthly_share_pps.pdf"),
-                color_map_global=color_map_global
-            )
 
     # overall %
     ser_cnt = None
@@ -346,11 +469,11 @@ def process_scope_dual(df_week_cnt: pd.DataFrame,
     return ser_cnt, ser_pps
 
 # 2×3 panel (count / pps) 
-def panel_top10_monthly_share_by_honeypot_2x3(c_scopes: dict, outdir: Path, color_map_global, mode: str):
+def panel_top10_monthly_share_by_honeypot_2x3(c_scopes: dict, outdir: Path, color_map_global, mode: str, xlim=None):
     rows = ["agnostic", "proxied", "emulated"]
     cols = ["RU", "UA"]
 
-    fig, axes = plt.subplots(nrows=3, ncols=2, figsize=(14, 10), sharex=True)
+    fig, axes, fresh = reuse_figure("panel_2x3", nrows=3, ncols=2, figsize=(14, 10), sharex=True)
     any_data = False
     global_xmin, global_xmax = None, None
 
@@ -362,14 +485,14 @@ def panel_top10_monthly_share_by_honeypot_2x3(c_scopes: dict, outdir: Path, colo
                 ax.text(0.5, 0.5, "No data", ha="center", va="center", transform=ax.transAxes); ax.set_yticks([]); continue
 
             if mode == "count":
-                df_week = dict_to_week_df(bkt["counts"], dtype=float)
+                df_week = bkt["counts"]
                 if df_week.empty:
                     ax.text(0.5, 0.5, "No data", ha="center", va="center", transform=ax.transAxes); ax.set_yticks([]); continue
                 df_month_raw = df_week.resample("MS").sum()
                 df_month = collapse_to_important(df_month_raw)
             else:
-                df_pkt = dict_to_week_df(bkt["packets"], dtype=float)
-                df_dur = dict_to_week_df(bkt["dur"], dtype=float)
+                df_pkt = bkt["packets"]
+                df_dur = bkt["dur"]
                 if df_pkt.empty or df_dur.empty:
                     ax.text(0.5, 0.5, "No data", ha="center", va="center", transform=ax.transAxes); ax.set_yticks([]); continue
                 df_month_pkt = df_pkt.resample("MS").sum()
@@ -384,8 +507,8 @@ def panel_top10_monthly_share_by_honeypot_2x3(c_scopes: dict, outdir: Path, colo
             pct = df_month.div(df_month.sum(axis=1).replace(0, np.nan), axis=0) * 100.0
             pct = pct.fillna(0.0)
 
-            cols_ordered = [col for col in DISPLAY_ORDER if col in pct.columns]
-            x = pct.index
+            cols_ordered = list(pct.columns)
+            x = date2num(pct.index)
             y = [pct[col].values for col in cols_ordered]
             colors = [color_map_global[col] for col in cols_ordered]
 
@@ -399,31 +522,50 @@ def panel_top10_monthly_share_by_honeypot_2x3(c_scopes: dict, outdir: Path, colo
             global_xmin = local_min if global_xmin is None else min(global_xmin, local_min)
             global_xmax = local_max if global_xmax is None else max(global_xmax, local_max)
 
+            ax.xaxis_date()
             ax.xaxis.set_major_locator(MonthLocator(interval=4))
-            ax.xaxis.set_major_formatter(DateFormatter("%Y-%m"))
-            for lbl in ax.get_xticklabels():
-                lbl.set_rotation(45); lbl.set_ha("right")
+            ax.xaxis.set_major_formatter(MONTH_FORMATTER)
 
-    if global_xmin is not None and global_xmax is not None:
+    if xlim is None and global_xmin is not None:
+        xlim = (global_xmin, global_xmax)
+    if xlim is not None:
         for ax in axes.ravel():
-            ax.set_xlim(global_xmin, global_xmax)
+            ax.set_xlim(*xlim)
             ax.margins(x=0)
+        for ax in axes[-1]:
+            for lbl in ax.get_xticklabels():
+                lbl.set_rotation(45); lbl.set_ha("right")
 
     axes[-1, 0].set_xlabel("Date")
     axes[-1, 1].set_xlabel("Date")
 
-    fig.tight_layout()
+    if fresh:
+        fig.tight_layout()
     out_png = outdir / f"panel_top10_monthly_share_by_honeypot_2x3_{mode}.png"
     out_pdf = outdir / f"panel_top10_monthly_share_by_honeypot_2x3_{mode}.pdf"
-    fig.savefig(out_png, dpi=160, bbox_inches="tight")
-    fig.savefig(out_pdf, dpi=160, bbox_inches="tight")
-    plt.close(fig)
+    fig.savefig(out_png, dpi=160)
+    fig.savefig(out_pdf, dpi=160)
     if any_data:
         print(f"[PANEL-{mode.upper()}] Wrote {out_png}")
         print(f"[PANEL-{mode.upper()}] Wrote {out_pdf}")
     else:
         print(f"[PANEL-{mode.upper()}] No data.")
 
+# LaTeX color macro per protocol (\legbox{clrDNS}{DNS})
+COLOR_MACRO = {
+    "DNS": "clrDNS", "NTP": "clrNTP", "WS-Discovery": "clrWSDiscovery", "SSDP": "clrSSDP",
+    "CLDAP": "clrCLDAP", "SNMP": "clrSNMP", "Chargen": "clrChargen",
+    "ARD": "clrARD", "CoAP": "clrCoAP", "Others": "clrOthers",
+}
+
+# table body: one row per protocol, "cnt & pps" for every column of df_cnt / df_pps (same columns)
+def table_rows(df_cnt: pd.DataFrame, df_pps: pd.DataFrame) -> list:
+    cnt = df_cnt.reindex(DISPLAY_ORDER).to_numpy()
+    pps = df_pps.reindex(DISPLAY_ORDER).to_numpy()
+    return [f"\\legbox{{{COLOR_MACRO.get(proto, 'clrOthers')}}}{{{proto}}} & "
+            + " & ".join(f"{c:.1f} & {p:.1f}" for c, p in zip(cnt[i], pps[i])) + r" \\"
+            for i, proto in enumerate(DISPLAY_ORDER)]
+
 # Combined table writer: 6 scopes (cnt|pps)
 def write_six_scopes_cnt_pps(cnt_map: dict, pps_map: dict, outdir: Path):
     scopes = ["RU-agnostic","RU-proxied","RU-emulated","UA-agnostic","UA-proxied","UA-emulated"]
@@ -436,23 +578,11 @@ def write_six_scopes_cnt_pps(cnt_map: dict, pps_map: dict, outdir: Path):
     wide = pd.concat({"Cnt": df_cnt, "PPS": df_pps}, axis=1)
     wide.to_csv(outdir / "overall_percentages_six_scopes_cnt_pps.csv", float_format="%.1f")
 
-    color_macro = {
-        "DNS": "clrDNS", "NTP": "clrNTP", "WS-Discovery": "clrWSDiscovery", "SSDP": "clrSSDP",
-        "CLDAP": "clrCLDAP", "SNMP": "clrSNMP", "Chargen": "clrChargen",
-        "ARD": "clrARD", "CoAP": "clrCoAP", "Others": "clrOthers",
-    }
     head_scopes = ["RU-agn.", "RU-prox.", "RU-emul.", "UA-agn.", "UA-prox.", "UA-emul."]
     header_line1 = " & " + " & ".join([f"\\multicolumn{{2}}{{c}}{{{h}}}" for h in head_scopes]) + r" \\"
     header_line2 = "Protocol & " + " & ".join(["Cnt & PPS"]*6) + r" \\"
 
-    lines = []
-    for proto in DISPLAY_ORDER:
-        cm = color_macro.get(proto, "clrOthers")
-        label = f"\\legbox{{{cm}}}{{{proto}}}"
-        vals = []
-        for k in scopes:
-            vals.append(f"{df_cnt.at[proto,k]:.1f} & {df_pps.at[proto,k]:.1f}")
-        lines.append(f"{label} & " + " & ".join(vals) + r" \\")
+    lines = table_rows(df_cnt, df_pps)
     tex = r"""\begin{table}[t]
 \raggedright
 \scriptsize
@@ -506,24 +636,11 @@ def write_all_ru_ua_and_six_cnt_pps(cnt_map: dict, pps_map: dict, outdir: Path):
     wide.to_csv(outdir / "overall_percentages_all_ru_ua_and_six_cnt_pps.csv", float_format="%.1f")
 
     # LaTeX table
-    color_macro = {
-        "DNS": "clrDNS", "NTP": "clrNTP", "WS-Discovery": "clrWSDiscovery", "SSDP": "clrSSDP",
-        "CLDAP": "clrCLDAP", "SNMP": "clrSNMP", "Chargen": "clrChargen",
-        "ARD": "clrARD", "CoAP": "clrCoAP", "Others": "clrOthers",
-    }
-
     human_headers = [alias for _, alias in cols_all]  # shown in table
     header_line1 = " & " + " & ".join([f"\\multicolumn{{2}}{{c}}{{{h}}}" for h in human_headers]) + r" \\"
     header_line2 = "Protocol & " + " & ".join(["Count & pps"]*len(human_headers)) + r" \\"
 
-    lines = []
-    for proto in DISPLAY_ORDER:
-        cm = color_macro.get(proto, "clrOthers")
-        label = f"\\legbox{{{cm}}}{{{proto}}}"
-        vals = []
-        for alias in human_headers:
-            vals.append(f"{df_cnt.at[proto,alias]:.1f} & {df_pps.at[proto,alias]:.1f}")
-        lines.append(f"{label} & " + " & ".join(vals) + r" \\")
+    lines = table_rows(df_cnt, df_pps)
     tex = r"""\begin{table}[t]
 \raggedright
 \scriptsize
@@ -545,78 +662,123 @@ def write_all_ru_ua_and_six_cnt_pps(cnt_map: dict, pps_map: dict, outdir: Path):
     (outdir / "table_overall_percentages_all_ru_ua_and_six_cnt_pps.tex").write_text(tex, encoding="utf-8")
     print("[COMBINED-ALL+6] Wrote overall_percentages_all_ru_ua_and_six_cnt_pps.csv and table_overall_percentages_all_ru_ua_and_six_cnt_pps.tex")
 
+# one monthly file -> long-form aggregate (AGG_KEYS index, AGG_VALS columns), or None if nothing matches
+def process_file(fpath):
+    # per-chunk long-form aggregates
+    parts = []
+    for chunk in iter_chunks(fpath):
+        # chunks hold strict RU/UA rows only (filtered in iter_chunks)
+        cc  = norm_labels(chunk[COUNTRY_COL], str.upper)
+        s   = pd.to_datetime(chunk[START_COL], errors="coerce", utc=True)
+        e   = pd.to_datetime(chunk[END_COL],   errors="coerce", utc=True)
+        valid = (s.notna() & e.notna() & (e > s)).to_numpy()
+        if not valid.any():
+            continue
+
+        s = s[valid]; e = e[valid]; cc = cc[valid]; chunk = chunk[valid]
+        dp  = chunk[DPORT_COL]
+        pkt = pd.to_numeric(chunk[PKT_COL], errors="coerce").fillna(0)
+        ht  = (norm_labels(chunk[HONTYPE_COL], lambda v: v.lower().strip())
+               if HONTYPE_COL in chunk.columns else np.full(len(chunk), "unknown", dtype=object))
+        # protocol labelling (categorical over DISPLAY_ORDER)
+        proto = proto_codes(dp)
+
+        # split every attack into its week slices at once; then fold per (country, honeypot, proto, week)
+        s64 = s.values.astype("datetime64[ns]").view("i8")
+        e64 = e.values.astype("datetime64[ns]").view("i8")
+        row, week, overlap = expand_weeks(s64, e64)
+        D = np.maximum((e64 - s64) / 1e9, 1.0)
+        # (cc, ht, proto) as one small int per attack, combined with the week into a single int64 key
+        cc_id, cc_lbl = pd.factorize(cc)
+        ht_id, ht_lbl = pd.factorize(ht)
+        n_ht, n_pr = len(ht_lbl), len(DISPLAY_ORDER)
+        grp = (cc_id * n_ht + ht_id) * n_pr + proto.codes
+        w0, n_wk = week.min(), int(week.max() - week.min()) + 1
+        key = grp[row].astype(np.int64) * n_wk + (week - w0)
+        # cnt / pkt / dur fused into one (slices, 3) matrix, summed per key: sort once, then add contiguous runs
+        order = np.argsort(key, kind="stable")
+        key = key[order]; row = row[order]; overlap = overlap[order]
+        vals = np.empty((len(row), 3))
+        vals[:, 0] = 1.0
+        vals[:, 1] = pkt.values[row].astype(float) * (overlap / D[row])  # distribute the number of packets to each week
+        vals[:, 2] = overlap                                              # all duration
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        k = key[starts]
+        g, wk = k // n_wk, k % n_wk + w0
+        sums = pd.DataFrame(np.add.reduceat(vals, starts, axis=0), columns=AGG_VALS)
+        parts.append(sums.set_axis(pd.MultiIndex.from_arrays([
+            cc_lbl[g // (n_ht * n_pr)], ht_lbl[g // n_pr % n_ht],
+            pd.Categorical.from_codes(g % n_pr, dtype=PROTO_DTYPE), wk], names=AGG_KEYS)))
+    if not parts:
+        return None
+    return pd.concat(parts).groupby(level=AGG_KEYS, sort=False, observed=True).sum()
+
+# everything process_file() output depends on besides the input file (countries, columns, protocol mapping)
+AGG_CONFIG = hashlib.sha1(repr((TARGET_COUNTRIES, USECOLS_BASE, DISPLAY_ORDER, AGG_KEYS, AGG_VALS)).encode()
+                          + PROTO_LUT.tobytes()).hexdigest()[:12]
+
+# process_file() through CACHE_DIR: <name>.<path hash>.<AGG_CONFIG>.<mtime_ns>.parquet; the path hash keeps
+# same-named files of different BASE_DIRs apart, and a changed input or config gets a new key
+def cached_process_file(fpath):
+    if CACHE_DIR is None:
+        return process_file(fpath)
+    key = f"{fpath.name}.{hashlib.sha1(str(fpath.resolve()).encode()).hexdigest()[:12]}"
+    cache = CACHE_DIR / f"{key}.{AGG_CONFIG}.{fpath.stat().st_mtime_ns}.parquet"
+    if cache.exists():
+        df = pq.read_table(cache).to_pandas()
+        return None if df.empty else df
+    df = process_file(fpath)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    for old in CACHE_DIR.glob(f"{key}.*.parquet"):
+        old.unlink(missing_ok=True)
+    out = df if df is not None else pd.DataFrame(columns=AGG_KEYS + AGG_VALS).set_index(AGG_KEYS)
+    tmp = cache.with_suffix(".tmp")
+    pq.write_table(pa.Table.from_pandas(out), tmp, compression="zstd")
+    tmp.replace(cache)
+    return df
+
 # main flow 
 def process_all():
     files = enumerate_all_files()
     if not files:
-        raise FileNotFoundError(f"No input CSVs in {BASE_DIR.resolve()}")
+        raise FileNotFoundError(f"No input partitions in {BASE_DIR.resolve()}")
     ensure_columns(files[0])
 
+    # dataset loading: files are independent, aggregated in WORKERS processes and summed at the end
+    if WORKERS > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=min(WORKERS, len(files))) as ex:
+            parts = list(tqdm(ex.map(cached_process_file, files), total=len(files), desc="Files", unit="file"))
+    else:
+        parts = [cached_process_file(fpath) for fpath in tqdm(files, desc="Files", unit="file")]
+    parts = [p for p in parts if p is not None]
+
+    agg = (pd.concat(parts).groupby(level=AGG_KEYS, observed=True).sum().reset_index() if parts
+           else pd.DataFrame(columns=AGG_KEYS + AGG_VALS))
+
     # Base scopes
-    base_scopes = { "ALL": mk_scope_bucket(), "RU": mk_scope_bucket(), "UA": mk_scope_bucket() }
+    base_scopes = { "ALL": scope_frames(agg), "RU": scope_frames(agg, cc="RU"), "UA": scope_frames(agg, cc="UA") }
 
     # honeypot type scopes for ALL/RU/UA
     contype_values = ["agnostic", "proxied", "emulated"]
-    c_scopes = { ct: { "ALL": mk_scope_bucket(), "RU": mk_scope_bucket(), "UA": mk_scope_bucket() }
+    c_scopes = { ct: { "ALL": scope_frames(agg, ht=ct), "RU": scope_frames(agg, cc="RU", ht=ct),
+                       "UA": scope_frames(agg, cc="UA", ht=ct) }
                  for ct in contype_values }
 
-    # dataset loading
-    for fpath in tqdm(files, desc="Files", unit="file"):
-        for chunk in pd.read_csv(
-            fpath, usecols=USECOLS_BASE, dtype=DTYPE_MAP,
-            chunksize=CHUNKSIZE, low_memory=False, on_bad_lines="skip", engine="c"
-        ):
-            s   = pd.to_datetime(chunk[START_COL], errors="coerce", utc=True)
-            e   = pd.to_datetime(chunk[END_COL],   errors="coerce", utc=True)
-            cc  = chunk[COUNTRY_COL].astype(str).str.upper()
-            con = chunk[CONS_COL].astype(str).str.lower()
-            dp  = chunk[DPORT_COL].astype(str)
-            pkt = pd.to_numeric(chunk[PKT_COL], errors="coerce")
-            ht  = (chunk[HONTYPE_COL].astype(str).str.lower().str.strip()
-                   if HONTYPE_COL in chunk.columns else pd.Series(["unknown"]*len(chunk)))
-
-            # RU/UA + strict only
-            mask = (s.notna() & e.notna() & (e > s) & (con == "strict") & (cc.isin(TARGET_COUNTRIES)))
-            if not mask.any():
-                continue
-
-            s = s[mask]; e = e[mask]; cc = cc[mask]; dp = dp[mask]; ht = ht[mask]; pkt = pkt[mask].fillna(0)
-            # protocol labelling
-            proto = dp.map(map_port_to_proto).map(canonical_protocol)
-
-            for s_i, e_i, ccode, proto_lbl, honeypot_type, K_i in zip(s.values, e.values, cc.values, proto.values, ht.values, pkt.values):
-                s_i = to_utc(s_i); e_i = to_utc(e_i)
-                D_i = max((e_i - s_i).total_seconds(), 1.0)
-                for ws in iter_week_starts(s_i, e_i):
-                    w_start = ws; w_end = ws + pd.Timedelta(days=7)
-                    overlap = (min(e_i, w_end) - max(s_i, w_start)).total_seconds()
-                    if overlap <= 0:
-                        continue
-                    frac = overlap / D_i
-
-                    for key in ["ALL", ccode]:
-                        base_scopes[key]["counts"][proto_lbl][ws]  += 1 # count +1 to certain week
-                        base_scopes[key]["packets"][proto_lbl][ws] += float(K_i) * frac # distribute the number of packets to each week
-                        base_scopes[key]["dur"][proto_lbl][ws]     += overlap # all duration
-
-                    if honeypot_type in c_scopes:
-                        for key in ["ALL", ccode]:
-                            c_scopes[honeypot_type][key]["counts"][proto_lbl][ws]  += 1
-                            c_scopes[honeypot_type][key]["packets"][proto_lbl][ws] += float(K_i) * frac
-                            c_scopes[honeypot_type][key]["dur"][proto_lbl][ws]     += overlap
-
     # colors
     color_map_global = build_global_color_map(set(IMPORTANT_PROTOCOLS + ["Others"]))
 
+    # one month range for every plot (first .. last month with data), as matplotlib date numbers
+    all_weeks = base_scopes["ALL"]["counts"].index
+    xlim = (tuple(date2num(all_weeks[[0, -1]].tz_localize(None).to_period("M").to_timestamp()))
+            if len(all_weeks) else None)
+
     # process scopes: overall series maps
     percent_cnt_map, percent_pps_map = {}, {}
 
     for scope_name, bucket in base_scopes.items():
-        df_week_cnt = dict_to_week_df(bucket["counts"], dtype=float)
-        df_week_pkt = dict_to_week_df(bucket["packets"], dtype=float)
-        df_week_dur = dict_to_week_df(bucket["dur"], dtype=float)
+        df_week_cnt, df_week_pkt, df_week_dur = bucket["counts"], bucket["packets"], bucket["dur"]
         ser_cnt, ser_pps = process_scope_dual(df_week_cnt, df_week_pkt, df_week_dur,
-                                              scope_name, OUTDIR, color_map_global)
+                                              scope_name, OUTDIR, color_map_global, xlim)
         if ser_cnt is not None: percent_cnt_map[scope_name] = ser_cnt
         if ser_pps is not None: percent_pps_map[scope_name] = ser_pps
 
@@ -624,19 +786,17 @@ def process_all():
         ct_dir = OUTDIR / f"by_honeypot_{ct}"
         ct_dir.mkdir(parents=True, exist_ok=True)
         for scope_name, bucket in scope_dict.items():
-            df_week_cnt = dict_to_week_df(bucket["counts"], dtype=float)
-            df_week_pkt = dict_to_week_df(bucket["packets"], dtype=float)
-            df_week_dur = dict_to_week_df(bucket["dur"], dtype=float)
+            df_week_cnt, df_week_pkt, df_week_dur = bucket["counts"], bucket["packets"], bucket["dur"]
             ser_cnt, ser_pps = process_scope_dual(df_week_cnt, df_week_pkt, df_week_dur,
-                                                  f"{ct.upper()}_{scope_name}", ct_dir, color_map_global)
+                                                  f"{ct.upper()}_{scope_name}", ct_dir, color_map_global, xlim)
             if scope_name in ("RU","UA"):
                 key = f"{scope_name}-{ct}"
                 if ser_cnt is not None: percent_cnt_map[key] = ser_cnt
                 if ser_pps is not None: percent_pps_map[key] = ser_pps
 
     # panels
-    panel_top10_monthly_share_by_honeypot_2x3(c_scopes, OUTDIR, color_map_global, mode="count")
-    panel_top10_monthly_share_by_honeypot_2x3(c_scopes, OUTDIR, color_map_global, mode="pps")
+    panel_top10_monthly_share_by_honeypot_2x3(c_scopes, OUTDIR, color_map_global, mode="count", xlim=xlim)
+    panel_top10_monthly_share_by_honeypot_2x3(c_scopes, OUTDIR, color_map_global, mode="pps", xlim=xlim)
 
     # existing six-scope table
     write_six_scopes_cnt_pps(percent_cnt_map, percent_pps_map, OUTDIR)
@@ -645,7 +805,10 @@ def process_all():
 
 # entrypoint
 def main():
-    process_all()
+    try:
+        process_all()
+    finally:
+        close_figures()
 
 if __name__ == "__main__":
     main()